@@ -0,0 +1,224 @@
+import os
+import sys
+import json
+import time
+import math
+import random
+import argparse
+import tracemalloc
+# ---------------------------- #
+os.environ.setdefault('NUM_CARS', '1')
+os.environ.setdefault('CAR_SPEED', '0.0005')
+
+import virtualCar_anomaly as sim
+from mqtt_fleet import publisher
+from routes import route_index, route_cache
+# ------------------------------------------------------------------------------ #
+# Micro-benchmarks of the per-tick hot path, without any broker.
+#
+#   python3 benchmark.py              run and compare with bench_baseline.json
+#   python3 benchmark.py --save       run and store the results as the new baseline
+#
+# Every case reports operations per second (calls, or car ticks for the fleet
+# cases) and the peak memory allocated while running a fixed number of them.
+# ------------------------------------------------------------------------------ #
+
+route_sizes = [10, 1000, 100000]
+fleet_sizes = [1, 100, 10000]
+
+# Points of the route shared by every car of the fleet cases
+fleet_route = 100
+
+def synthetic_route(points, seed=0):
+    rng = random.Random(seed)
+    longitude, latitude = 2.17, 41.40
+    coordinates = []
+    for _ in range(points):
+        coordinates.append([longitude, latitude])
+        angle = rng.uniform(-math.pi, math.pi)
+        longitude += math.cos(angle) * 0.0001
+        latitude += math.sin(angle) * 0.0001
+    return coordinates
+
+def make_car(id, route, clientS, stepper=None):
+    car = sim.vcar(id, clientS, stepper)
+    car.route = route
+    return car
+
+# ------------------------------------------------------------------------------ #
+# Every case returns a function that runs a batch of operations and returns how
+# many it ran.
+
+def case_get_angle():
+    def run():
+        for _ in range(1000):
+            sim.get_angle(41.40, 2.17, 41.41, 2.18)
+        return 1000
+    return run
+
+def case_interpolation_to_coord(points, clientS):
+    car = make_car(1, route_index(synthetic_route(points)), clientS)
+    car.distance = car.route.length / 2
+    def run():
+        for _ in range(1000):
+            car.interpolation_to_coord()
+        return 1000
+    return run
+
+def case_interpolation_to_next_coord(points, clientS):
+    car = make_car(1, route_index(synthetic_route(points)), clientS)
+    def run():
+        for _ in range(1000):
+            if car.distance >= car.route.length:
+                car.distance = 0
+            car.interpolation_to_next_coord()
+        return 1000
+    return run
+
+def case_move_car(clientS):
+    car = make_car(1, route_index(synthetic_route(10)), clientS)
+    def run():
+        for _ in range(1000):
+            car.move_car(0.5, (0.0001, 0.0001), car.battery_level, car.autonomy)
+        return 1000
+    return run
+
+def case_send_location(clientS):
+    car = make_car(1, route_index(synthetic_route(10)), clientS)
+    def run():
+        for _ in range(1000):
+            car.send_location(car.ID, (41.40, 2.17), 3, car.battery_level, car.autonomy)
+        return 1000
+    return run
+
+def case_route_index(points):
+    coordinates = synthetic_route(points)
+    def run():
+        route_index(coordinates)
+        return 1
+    return run
+
+# STARTROUTE route string to compiled route, as on a route cache miss
+def case_route_ingest(points):
+    raw = json.dumps(synthetic_route(points))
+    def run():
+        route_cache(0).get(raw)
+        return 1
+    return run
+
+def case_fleet_scalar(cars, clientS):
+    route = route_index(synthetic_route(fleet_route))
+    fleet = [make_car(i, route, clientS) for i in range(1, cars+1)]
+    rides = [car.drive() for car in fleet]
+    def run():
+        for k, car in enumerate(fleet):
+            if next(rides[k], None) is None:
+                car.distance = 0
+                rides[k] = car.drive()
+        return cars
+    return run
+
+def case_fleet_numpy(cars, clientS):
+    from fleet_stepper import fleet_stepper
+    stepper = fleet_stepper(sim.car_speed, sim.delta_time)
+    route = route_index(synthetic_route(fleet_route))
+    fleet = [make_car(i, route, clientS, stepper) for i in range(1, cars+1)]
+    rides = [stepper.add(car) for car in fleet]
+    def run():
+        for k, car in enumerate(fleet):
+            if rides[k].is_set():
+                car.distance = 0
+                rides[k] = stepper.add(car)
+        stepper.step()
+        return cars
+    return run
+
+def cases(clientS):
+    yield "get_angle", case_get_angle
+    for points in route_sizes:
+        yield "interpolation_to_coord[%d]" % points, lambda points=points: case_interpolation_to_coord(points, clientS)
+        yield "interpolation_to_next_coord[%d]" % points, lambda points=points: case_interpolation_to_next_coord(points, clientS)
+    yield "move_car", lambda: case_move_car(clientS)
+    yield "send_location", lambda: case_send_location(clientS)
+    for points in route_sizes:
+        yield "route_index[%d]" % points, lambda points=points: case_route_index(points)
+    for points in route_sizes:
+        yield "route_ingest[%d]" % points, lambda points=points: case_route_ingest(points)
+    for cars in fleet_sizes:
+        yield "fleet_scalar[%d]" % cars, lambda cars=cars: case_fleet_scalar(cars, clientS)
+    try:
+        import numpy
+    except ImportError:
+        return
+    for cars in fleet_sizes:
+        yield "fleet_numpy[%d]" % cars, lambda cars=cars: case_fleet_numpy(cars, clientS)
+
+# ------------------------------------------------------------------------------ #
+
+def measure(run, min_time):
+    # Warm up, then time batches until min_time has passed
+    run()
+    ops = 0
+    start = time.perf_counter()
+    while True:
+        ops += run()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+    ops_per_sec = ops / elapsed
+
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return ops_per_sec, peak / 1024
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks of the virtual car hot path")
+    parser.add_argument("--baseline", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json"))
+    parser.add_argument("--save", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds spent timing every case")
+    parser.add_argument("--threshold", type=float, default=0.8, help="flag cases slower than this fraction of the baseline")
+    parser.add_argument("--filter", default="", help="only run the cases whose name contains this text")
+    args = parser.parse_args()
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+
+    clientS = publisher(None, None, wire=sim.wire)
+
+    results = {}
+    regressions = 0
+    print("%-36s %14s %11s %9s" % ("case", "ops/s", "peak KiB", "vs base"))
+    for name, setup in cases(clientS):
+        if args.filter not in name:
+            continue
+
+        ops_per_sec, peak_kib = measure(setup(), args.min_time)
+
+        results[name] = {"ops_per_sec": round(ops_per_sec, 1), "peak_kib": round(peak_kib, 1)}
+
+        compare = ""
+        if name in baseline:
+            ratio = ops_per_sec / baseline[name]["ops_per_sec"]
+            compare = "%.2fx" % ratio
+            if ratio < args.threshold:
+                compare += " REGRESSIÓ"
+                regressions += 1
+
+        print("%-36s %14.1f %11.1f %9s" % (name, ops_per_sec, peak_kib, compare), flush=True)
+
+    if args.save:
+        baseline.update(results)
+        with open(args.baseline, "w") as file:
+            json.dump(baseline, file, indent=4, sort_keys=True)
+            file.write("\n")
+        print("Baseline guardada a " + args.baseline)
+
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,46 @@
+# ------------------------------------------------------------------------------ #
+# Life of a virtual car as a transition table. vcar.lifecycle() walks it: on
+# entering a step it runs the action (a vcar method), publishes the status_car
+# state, spends the wait and moves on to the next step. When next is a dict the
+# step is chosen by vcar.outcome():
+#
+#   ok          nothing pending
+#   battery     a battery anomaly is pending and the car went on
+#   turned      a battery anomaly made the car turn around mid-route
+#   breakdown   the car broke down, it stays in alert for good
+#
+# A forced anomaly is just another transition, no step blocks a thread.
+# ------------------------------------------------------------------------------ #
+
+# Waits that are not a number of simulated seconds
+ROUTE = "route"     # until on_startroute gives the car a route
+RIDE = "ride"       # the ride along the route (vcar.start_car)
+
+steps = {
+    # step              status  action              wait    next
+    "waits":            (None,  None,               ROUTE,  "loading"),
+    "loading":          (1,     None,               10,     "delivering"),
+    "delivering":       (3,     None,               RIDE,   {"ok": "unloading_c", "battery": "alert_hive", "turned": "alert_road", "breakdown": "breakdown"}),
+    "unloading_c":      (2,     None,               5,      {"ok": "returning", "battery": "alert_hive", "breakdown": "breakdown"}),
+    "returning":        (4,     None,               RIDE,   {"ok": "finished", "battery": "alert_home", "breakdown": "breakdown"}),
+    "finished":         (5,     "finish",           0,      "waits"),
+
+    # Battery anomalies: report, then unload and go back to the warehouse
+    "alert_hive":       (7,     "battery_alert",    1,      "unloading_c"),
+    "alert_road":       (7,     "battery_alert",    1,      "returning_alert"),
+    "alert_home":       (7,     "battery_alert",    1,      "unloading_a"),
+    "returning_alert":  (4,     None,               RIDE,   {"ok": "unloading_a", "breakdown": "breakdown"}),
+    "unloading_a":      (8,     None,               5,      "finished"),
+
+    # The car stops where it is and waits for a technician
+    "breakdown":        (7,     "breakdown",        0,      None),
+}
+
+# Anomalies that can be forced on PTIN2023/CAR/ANOMALIA ("hehe"): kind, battery
+# level and the description of the report
+anomalies = {
+    "set_battery_10":   ("battery", 10, "ATENCIÓ: Nivell de bateria baix, %d%%. Accions: Retornant al punt de carga..."),
+    "set_battery_5":    ("battery", 5, "CRÍTIC: Nivell de bateria critic, %d%%. Accions: Retornant al punt de carga..."),
+    "breakdown":        ("breakdown", None, "CRÍTIC: El cotxe ha sofert un problema tècnic. Codi d'error: %s. Accions: Es requereix que un tècnic es desplaçi a l'útima localització del cotxe."),
+    "unncomunicate":    ("breakdown", None, "CRÍTIC: El cotxe ha sofert un problema tècnic. Codi d'error: %s. Accions: Es requereix que un tècnic es desplaçi a l'útima localització del cotxe.")
+}
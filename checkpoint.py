@@ -0,0 +1,113 @@
+import os
+import struct
+from array import array
+# ---------------------------- #
+from routes import route_index
+from car_states import steps, anomalies
+from fleet_log import fleet_log
+# ------------------------------------------------------------------------------ #
+# Snapshots of the fleet state, so a restarted simulator resumes every car at
+# the step and the point of the route where it was. Little endian binary file:
+#
+#   header  "VCK1" | simulated time f64 | routes u32 | cars u32
+#   route   points u32 | lon lat f64 * points | arc length f64 * points
+#   car     id u32 | step u8 | status u8 | car_return u8 | anomaly i8 |
+#           anomalia_forcada u8 | ride_stopped u8 | route i32 |
+#           distance f64 | interpolation_val f64 | battery f64 | autonomy f64
+#
+# Every route shared by several cars is stored once. The file is written next
+# to the old one and renamed over it, so a crash never leaves half a snapshot.
+# ------------------------------------------------------------------------------ #
+
+magic = b"VCK1"
+header = struct.Struct("<4sdII")
+car_record = struct.Struct("<IBBBbBBidddd")
+
+# Steps and anomalies by index, None (a broken down car) is the last step
+step_names = list(steps) + [None]
+anomaly_names = list(anomalies)
+
+def write(path, cars, now=0.0):
+    routes = {}
+    records = []
+    for car in cars:
+        # Between two steps of the car (see vcar.lock), one car at a time
+        with car.lock:
+            route = car.route
+            index = -1
+            if route is not None:
+                index = routes.setdefault(id(route), (len(routes), route))[0]
+
+            records.append(car_record.pack(
+                car.ID, step_names.index(car.state), car.status, car.car_return,
+                anomaly_names.index(car.anomalia) if car.anomalia in anomalies else -1,
+                car.anomalia_forcada, car.ride_stopped, index,
+                car.distance, car.interpolation_val, car.battery_level, car.autonomy))
+
+    temporary = path + ".tmp"
+    with open(temporary, "wb") as file:
+        file.write(header.pack(magic, now, len(routes), len(records)))
+        for _, route in routes.values():
+            file.write(struct.pack("<I", len(route)))
+            file.write(route.points.tobytes())
+            file.write(route.cumulative.tobytes())
+        file.write(b"".join(records))
+    os.replace(temporary, path)
+
+# Restores the cars of the snapshot that are in the fleet (by id) and returns
+# how many were restored
+def restore(path, cars):
+    with open(path, "rb") as file:
+        data = file.read()
+
+    tag, now, num_routes, num_cars = header.unpack_from(data)
+    if tag != magic:
+        raise ValueError("%s is not a fleet checkpoint" % path)
+    offset = header.size
+
+    routes = []
+    for _ in range(num_routes):
+        (points,) = struct.unpack_from("<I", data, offset)
+        offset += 4
+        coordinates = array('d', data[offset:offset + 16*points])
+        offset += 16*points
+        cumulative = array('d', data[offset:offset + 8*points])
+        offset += 8*points
+        routes.append(route_index(coordinates, cumulative))
+
+    fleet = {car.ID: car for car in cars}
+    restored = 0
+    for _ in range(num_cars):
+        (id, step, status, car_return, anomaly, forced, ride_stopped, route,
+         distance, interpolation_val, battery_level, autonomy) = car_record.unpack_from(data, offset)
+        offset += car_record.size
+
+        car = fleet.get(id)
+        if car is None:
+            continue
+
+        car.state = step_names[step]
+        car.status = status
+        car.car_return = bool(car_return)
+        car.anomalia = anomaly_names[anomaly] if anomaly >= 0 else None
+        car.anomalia_forcada = bool(forced)
+        car.ride_stopped = bool(ride_stopped)
+        car.route = routes[route] if route >= 0 else None
+        car.distance = distance
+        car.interpolation_val = interpolation_val
+        car.battery_level = battery_level
+        car.autonomy = autonomy
+        car.resume = True
+        restored += 1
+
+    fleet_log.info("CHECKPOINT | %d cotxes restaurats de %s (t=%.2f s)", restored, path, now)
+    return restored
+
+# Simulation process that writes a snapshot every interval seconds
+def process(path, cars, clock, interval=5.0):
+    while True:
+        yield interval
+        try:
+            write(path, cars, clock.now())
+        except OSError as error:
+            fleet_log.error("CHECKPOINT | Error escrivint %s: %s", path, error)
@@ -0,0 +1,94 @@
+import math
+# ---------------------------- #
+from wire_format import loads
+# ------------------------------------------------------------------------------ #
+# Schema of the commands sent by the cloud. Every message is decoded once and
+# checked here, before it reaches any car, so bad payloads cost one parse and a
+# few type checks. The route of STARTROUTE may come as the original JSON string
+# or already as an array, it is decoded into points by routes.route_cache.
+# NEAREST (see spatial.py) and FLEETSTATUS (see fleet_table.py) are fleet-wide
+# requests, answered on "reply_to" or on the same topic followed by /RESPONSE,
+# with the same "request_id".
+# ------------------------------------------------------------------------------ #
+
+schemas = {
+    "PTIN2023/CAR/STARTROUTE": {
+        "id_car":   int,
+        "order":    int,
+        "route":    (str, list)
+    },
+    "PTIN2023/CAR/ANOMALIA": {
+        "id_car":   int,
+        "hehe":     str
+    },
+    "PTIN2023/CAR/NEAREST": {
+        "latitude":     (int, float),
+        "longitude":    (int, float)
+    },
+    "PTIN2023/CAR/FLEETSTATUS": {}
+}
+
+# Fields that may be missing, checked only when they are there
+optional = {
+    "PTIN2023/CAR/NEAREST": {
+        "k":            int,
+        "radius":       (int, float),
+        "state":        str,
+        "request_id":   (str, int),
+        "reply_to":     str
+    },
+    "PTIN2023/CAR/FLEETSTATUS": {
+        "state":        str,
+        "request_id":   (str, int),
+        "reply_to":     str
+    }
+}
+
+# Allowed range of numeric fields, both ends included. Infinities and NaN are
+# never allowed: the stdlib decoder accepts Infinity and 1e400.
+ranges = {
+    "PTIN2023/CAR/NEAREST": {
+        "latitude":     (-90, 90),
+        "longitude":    (-180, 180),
+        "radius":       (0, math.inf),
+        "k":            (1, math.inf)
+    }
+}
+
+class command_error(ValueError):
+    pass
+
+# Decoded and validated payload of a command, raises command_error otherwise
+def parse(topic, raw):
+    schema = schemas[topic]
+
+    try:
+        payload = loads(raw)
+    except ValueError:
+        raise command_error("not JSON") from None
+
+    if not isinstance(payload, dict):
+        raise command_error("not a JSON object")
+
+    for key, kind in schema.items():
+        value = payload.get(key)
+        if value is None:
+            raise command_error("missing " + key)
+        if not isinstance(value, kind) or isinstance(value, bool):
+            raise command_error("wrong type of " + key)
+
+    for key, kind in optional.get(topic, {}).items():
+        value = payload.get(key)
+        if value is not None and (not isinstance(value, kind) or isinstance(value, bool)):
+            raise command_error("wrong type of " + key)
+
+    for key, (low, high) in ranges.get(topic, {}).items():
+        value = payload.get(key)
+        if value is None:
+            continue
+        if isinstance(value, float) and not math.isfinite(value):
+            raise command_error(key + " must be finite")
+        if not low <= value <= high:
+            raise command_error("%s out of range [%s, %s]" % (key, low, high))
+
+    return payload
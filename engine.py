@@ -0,0 +1,181 @@
+import time
+import heapq
+import asyncio
+import itertools
+import threading
+import metrics
+# ------------------------------------------------------------------------------ #
+# A simulation process (a car lifecycle, the fleet stepper, ...) is a generator
+# that yields either the simulated seconds it has to wait or a waiter to block
+# on. The same process can be driven by a thread, by a coroutine or by the
+# discrete event clock.
+# ------------------------------------------------------------------------------ #
+
+class waiter:
+    # One-shot wake-up that a process can yield instead of a delay. It can be
+    # released from any thread and waited on by every engine.
+    def __init__(self) -> None:
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.callbacks = []
+
+    def set(self):
+        with self.lock:
+            self.event.set()
+            callbacks, self.callbacks = self.callbacks, []
+
+        for callback in callbacks:
+            callback()
+
+    def is_set(self):
+        return self.event.is_set()
+
+    # Runs callback once the waiter is set, right away if it already is
+    def add_callback(self, callback):
+        with self.lock:
+            if not self.event.is_set():
+                self.callbacks.append(callback)
+                return
+        callback()
+
+    def wait(self):
+        self.event.wait()
+
+    async def wait_async(self):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.add_callback(lambda: loop.call_soon_threadsafe(resolve, future))
+        await future
+
+def resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+# ------------------------------------------------------------------------------ #
+
+class clock:
+    # Wall clock with a time-scale factor: with scale=10 every simulated second
+    # only lasts 0.1 real seconds
+    def __init__(self, scale=1.0) -> None:
+        self.scale = scale
+        self.origin = time.monotonic()
+
+    def now(self):
+        return (time.monotonic() - self.origin) * self.scale
+
+    def sleep(self, seconds):
+        time.sleep(seconds / self.scale)
+
+    async def sleep_async(self, seconds):
+        await asyncio.sleep(seconds / self.scale)
+
+class virtual_clock:
+    # Discrete event clock: every process runs on one thread and the simulated
+    # time jumps straight to the next event, so days of fleet operation take as
+    # long as the CPU needs to compute them.
+    #
+    # Daemon processes (periodic checkpoints, scenarios) only run alongside
+    # other events: when they are all that is left and the run has no end,
+    # the clock parks until another thread schedules something, instead of
+    # spinning through virtual time on its own.
+    def __init__(self) -> None:
+        self.time = 0.0
+
+        # Heap of (time, seq, process or callback)
+        self.events = []
+        self.seq = itertools.count()
+        self.cond = threading.Condition()
+
+        # Daemon processes, and events in the heap that are not theirs
+        self.daemons = set()
+        self.active = 0
+
+    def now(self):
+        return self.time
+
+    def schedule(self, at, action):
+        with self.cond:
+            heapq.heappush(self.events, (at, next(self.seq), action))
+            if action not in self.daemons:
+                self.active += 1
+            self.cond.notify()
+
+    def spawn(self, process, daemon=False):
+        if daemon:
+            self.daemons.add(process)
+        self.schedule(self.time, process)
+
+    def call_later(self, delay, callback):
+        self.schedule(self.time + delay, callback)
+
+    def resume(self, process):
+        try:
+            delay = next(process)
+        except StopIteration:
+            return
+
+        if isinstance(delay, waiter):
+            # Woken up at the simulated time the waiter is released
+            delay.add_callback(lambda: self.schedule(self.time, process))
+        else:
+            self.schedule(self.time + delay, process)
+
+    # Runs the events until the simulated time reaches until (forever if None).
+    # When nothing is scheduled (only daemons, if forever) it blocks until
+    # another thread, like the MQTT dispatcher, schedules something, or returns
+    # if wait_external is False.
+    def run(self, until=None, wait_external=True):
+        while True:
+            with self.cond:
+                while not self.events or (until is None and not self.active):
+                    if not wait_external:
+                        return
+                    self.cond.wait()
+
+                at, _, action = self.events[0]
+                if until is not None and at > until:
+                    self.time = until
+                    return
+
+                heapq.heappop(self.events)
+                if action not in self.daemons:
+                    self.active -= 1
+                self.time = max(self.time, at)
+
+            if callable(action):
+                action()
+            else:
+                self.resume(action)
+
+# Runs process holding lock from every resume to its next yield, so other
+# threads only see its state between two steps
+def locked(process, lock):
+    while True:
+        with lock:
+            try:
+                delay = next(process)
+            except StopIteration:
+                return
+        yield delay
+
+# ------------------------------------------------------------------------------ #
+
+# Thread engine
+def run_thread(process, clock):
+    for delay in process:
+        if isinstance(delay, waiter):
+            delay.wait()
+        else:
+            due = clock.now() + delay
+            clock.sleep(delay)
+            metrics.woke(clock.now() - due, delay)
+
+# asyncio engine
+async def run_async(process, clock):
+    for delay in process:
+        if isinstance(delay, waiter):
+            await delay.wait_async()
+        else:
+            due = clock.now() + delay
+            await clock.sleep_async(delay)
+            metrics.woke(clock.now() - due, delay)
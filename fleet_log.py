@@ -0,0 +1,126 @@
+import sys
+import json
+import time
+import atexit
+import queue
+import logging
+import logging.handlers
+from threading import Thread
+from collections import Counter
+# ------------------------------------------------------------------------------ #
+# Logging of the simulator. Records go through a queue to a background thread
+# that writes them to a buffered stdout, flushed at most once per second, so
+# logging never costs a write syscall on the simulation threads.
+#
+#   vcars.car     status changes, routes and anomalies of every car
+#   vcars.tick    one line per car and tick, off unless LOG_TICKS=1 and then
+#                 limited to one line per car every TICK_LOG_INTERVAL seconds
+#   vcars.mqtt    publisher and dispatcher
+#   vcars.fleet   periodic fleet summaries
+# ------------------------------------------------------------------------------ #
+
+car_log = logging.getLogger("vcars.car")
+tick_log = logging.getLogger("vcars.tick")
+mqtt_log = logging.getLogger("vcars.mqtt")
+fleet_log = logging.getLogger("vcars.fleet")
+
+class json_formatter(logging.Formatter):
+    def format(self, record):
+        line = {"t": round(record.created, 3), "level": record.levelname, "logger": record.name, "msg": record.getMessage()}
+        if hasattr(record, "car"):
+            line["car"] = record.car
+        return json.dumps(line, ensure_ascii=False)
+
+class car_rate_limit(logging.Filter):
+    # Lets through at most one record per car every interval seconds
+    def __init__(self, interval) -> None:
+        super().__init__()
+        self.interval = interval
+        self.last = {}
+
+    def filter(self, record):
+        car = getattr(record, "car", None)
+        now = time.monotonic()
+        if now - self.last.get(car, -self.interval) < self.interval:
+            return False
+        self.last[car] = now
+        return True
+
+class buffered_handler(logging.StreamHandler):
+    # StreamHandler flushes after every record, this one at most once per interval
+    def __init__(self, stream, interval=1.0) -> None:
+        super().__init__(stream)
+        self.interval = interval
+        self.flushed = time.monotonic()
+
+    def flush(self):
+        if time.monotonic() - self.flushed >= self.interval:
+            self.force_flush()
+
+    def force_flush(self):
+        super().flush()
+        self.flushed = time.monotonic()
+
+# ------------------------------------------------------------------------------ #
+
+def setup(level="INFO", ticks=False, tick_interval=1.0, fmt="text"):
+    stream = open(sys.stdout.fileno(), "w", buffering=1 << 16, encoding="utf-8", closefd=False)
+    handler = buffered_handler(stream)
+    if fmt == "json":
+        handler.setFormatter(json_formatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+
+    records = queue.SimpleQueue()
+    root = logging.getLogger("vcars")
+    root.setLevel(level)
+    root.addHandler(logging.handlers.QueueHandler(records))
+    root.propagate = False
+
+    listener = logging.handlers.QueueListener(records, handler)
+    listener.start()
+
+    if ticks:
+        tick_log.setLevel(logging.DEBUG)
+        tick_log.addFilter(car_rate_limit(tick_interval))
+    else:
+        tick_log.setLevel(logging.WARNING)
+
+    # Nothing stays in the buffer for more than a second once things go quiet
+    def flusher():
+        while True:
+            time.sleep(handler.interval)
+            handler.acquire()
+            try:
+                handler.force_flush()
+            except OSError:
+                pass
+            finally:
+                handler.release()
+
+    Thread(target=flusher, daemon=True).start()
+
+    # Both threads are daemons, write out what is still queued or buffered
+    # (often the error logged just before a crash) when the process exits
+    def close():
+        listener.stop()
+        handler.acquire()
+        try:
+            handler.force_flush()
+        except OSError:
+            pass
+        finally:
+            handler.release()
+
+    atexit.register(close)
+    return listener
+
+# Logs how many cars are in every status_car state every interval seconds
+def start_summary(cars, status_names, interval=10.0):
+    def loop():
+        while True:
+            time.sleep(interval)
+            states = Counter(status_names[car.status] for car in cars)
+            fleet_log.info("FLOTA | Cotxes: %d | " % len(cars) + " | ".join("%s: %d" % item for item in sorted(states.items())))
+
+    Thread(target=loop, daemon=True).start()
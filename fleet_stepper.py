@@ -0,0 +1,291 @@
+import threading
+# ---------------------------- #
+import numpy as np
+from engine import waiter
+import metrics
+# ------------------------------------------------------------------------------ #
+
+class fleet_stepper:
+    # Moves every car that is on a route in a single batched operation per tick.
+    # The state of the moving cars is kept as a struct of arrays (one entry per
+    # car) and the math is the same as vcar.interpolation_to_next_coord and
+    # vcar.move_car, applied to the whole fleet at once. Positions are looked up
+    # with one searchsorted over the arc lengths of all the routes.
+    def __init__(self, car_speed, delta_time, publisher=None) -> None:
+        self.step_len = car_speed * delta_time
+        self.delta_time = delta_time
+
+        # Publisher whose fleet batch is flushed once per tick, if batching
+        self.publisher = publisher
+
+        # Cars added by their lifecycle, joined at the start of the next tick
+        self.lock = threading.Lock()
+        self.pending = []
+
+        # Released by add() while ticks() is parked with no car to move
+        self.idle = None
+
+        # Moving cars, in the same order as the arrays
+        self.cars = []
+        self.waiters = []
+
+        self.distance = np.zeros(0)
+        self.battery_level = np.zeros(0)
+        self.autonomy = np.zeros(0)
+
+        # Slot of the route of every car and, gathered from it, where the route
+        # is in the packed arrays
+        self.slot = np.zeros(0, dtype=np.intp)
+        self.offsets = np.zeros(0, dtype=np.intp)
+        self.lengths = np.zeros(0, dtype=np.intp)
+        self.route_start = np.zeros(0)
+        self.route_length = np.zeros(0)
+
+        # All the routes packed as one (points, 2) array of [longitude, latitude]
+        # and one cumulative arc length array, shifted so it grows across routes.
+        # A route is appended the first time a car takes it and keeps its slot
+        # while some car drives it (cars on the same shared route use a single
+        # copy). Freed routes are left where they are, the arc lengths still
+        # grow across them, until they take half of the points and the live
+        # ones are compacted.
+        self.points = np.zeros((0, 2))
+        self.cumulative = np.zeros(0)
+        self.used = 0
+        self.free_points = 0
+
+        # id(route) -> slot, and per slot: route (None when free), cars on it,
+        # offset, points, start and length in the packed arrays
+        self.slots = {}
+        self.free = []
+        self.slot_routes = []
+        self.slot_cars = []
+        self.slot_offset = []
+        self.slot_points = []
+        self.slot_start = []
+        self.slot_length = []
+
+    def add(self, car):
+        ride = waiter()
+        with self.lock:
+            self.pending.append((car, ride))
+            idle, self.idle = self.idle, None
+        if idle is not None:
+            idle.set()
+        return ride
+
+    def join(self, pending):
+        cars = []
+        for car, ride in pending:
+            if car.route.length <= 0:
+                # Nothing to drive, same as the scalar loop not running at all
+                ride.set()
+                continue
+
+            cars.append(car)
+            self.waiters.append(ride)
+        if not cars:
+            return
+
+        slot = np.array([self.take(car.route) for car in cars], dtype=np.intp)
+        offsets, lengths, route_start, route_length = self.gather(slot)
+
+        self.cars.extend(cars)
+        self.slot = np.concatenate([self.slot, slot])
+        self.offsets = np.concatenate([self.offsets, offsets])
+        self.lengths = np.concatenate([self.lengths, lengths])
+        self.route_start = np.concatenate([self.route_start, route_start])
+        self.route_length = np.concatenate([self.route_length, route_length])
+
+        self.distance = np.concatenate([self.distance, [car.distance for car in cars]])
+        self.battery_level = np.concatenate([self.battery_level, [car.battery_level for car in cars]])
+        self.autonomy = np.concatenate([self.autonomy, [car.autonomy for car in cars]])
+
+    def leave(self, keep):
+        for slot in self.slot[~keep].tolist():
+            self.release(slot)
+
+        self.cars = [car for car, k in zip(self.cars, keep) if k]
+        self.waiters = [ride for ride, k in zip(self.waiters, keep) if k]
+
+        self.slot = self.slot[keep]
+        self.offsets = self.offsets[keep]
+        self.lengths = self.lengths[keep]
+        self.route_start = self.route_start[keep]
+        self.route_length = self.route_length[keep]
+
+        self.distance = self.distance[keep]
+        self.battery_level = self.battery_level[keep]
+        self.autonomy = self.autonomy[keep]
+
+        if self.free_points * 2 > self.used:
+            self.compact()
+
+    # Slot of route, appended to the packed arrays if no car drives it yet
+    def take(self, route):
+        slot = self.slots.get(id(route))
+        if slot is None:
+            if self.free:
+                slot = self.free.pop()
+            else:
+                slot = len(self.slot_routes)
+                for column in (self.slot_routes, self.slot_cars, self.slot_offset, self.slot_points, self.slot_start, self.slot_length):
+                    column.append(None)
+
+            self.slots[id(route)] = slot
+            self.slot_routes[slot] = route
+            self.slot_cars[slot] = 0
+            self.place(slot)
+
+        self.slot_cars[slot] += 1
+        return slot
+
+    def release(self, slot):
+        self.slot_cars[slot] -= 1
+        if self.slot_cars[slot]:
+            return
+
+        del self.slots[id(self.slot_routes[slot])]
+        self.slot_routes[slot] = None
+        self.free.append(slot)
+        self.free_points += self.slot_points[slot]
+
+    # Copies the route of slot after the last packed point
+    def place(self, slot):
+        route = self.slot_routes[slot]
+        n = len(route)
+        start = self.cumulative[self.used - 1] if self.used else 0.0
+
+        if self.used + n > len(self.cumulative):
+            capacity = max(2 * len(self.cumulative), self.used + n)
+            points = np.zeros((capacity, 2))
+            cumulative = np.zeros(capacity)
+            points[:self.used] = self.points[:self.used]
+            cumulative[:self.used] = self.cumulative[:self.used]
+            self.points, self.cumulative = points, cumulative
+
+        self.points[self.used:self.used + n] = np.frombuffer(route.points).reshape(-1, 2)
+        self.cumulative[self.used:self.used + n] = np.frombuffer(route.cumulative) + start
+
+        self.slot_offset[slot] = self.used
+        self.slot_points[slot] = n
+        self.slot_start[slot] = start
+        self.slot_length[slot] = route.length
+        self.used += n
+
+    # Packs the live routes again without the freed ones, slots do not change
+    def compact(self):
+        live = sorted((offset, slot) for slot, offset in enumerate(self.slot_offset)
+                      if self.slot_routes[slot] is not None)
+        self.used = 0
+        self.free_points = 0
+        for _, slot in live:
+            self.place(slot)
+
+        self.offsets, self.lengths, self.route_start, self.route_length = self.gather(self.slot)
+
+    # Offsets, lengths, starts and lengths along the route of the given slots
+    def gather(self, slot):
+        return (np.array(self.slot_offset, dtype=np.intp)[slot],
+                np.array(self.slot_points, dtype=np.intp)[slot],
+                np.array(self.slot_start, dtype=float)[slot],
+                np.array(self.slot_length, dtype=float)[slot])
+
+    def step(self):
+        with self.lock:
+            pending, self.pending = self.pending, []
+        if pending:
+            self.join(pending)
+        if not self.cars:
+            return
+        metrics.ticks.inc(amount=len(self.cars))
+
+        # Current and next position of every car (vcar.interpolation_to_coord
+        # and vcar.interpolation_to_next_coord)
+        latitude, longitude, _ = self.position(self.distance)
+        distance = np.minimum(self.distance + self.step_len, self.route_length)
+        next_latitude, next_longitude, interpolation_val = self.position(distance)
+
+        # Battery and autonomy (vcar.move_car)
+        distance_traveled = np.sqrt((next_latitude - latitude)**2 + (next_longitude - longitude)**2)
+        battery_usage = distance_traveled / 0.10
+        battery_level = self.battery_level - battery_usage
+        autonomy = self.autonomy - distance_traveled / 100 * battery_level * 20
+
+        # Only what is left per car goes through Python: the write-back, the
+        # anomalies and the location message
+        keep = distance < self.route_length
+        rows = zip(self.cars, distance.tolist(), interpolation_val.tolist(), battery_level.tolist(),
+                   autonomy.tolist(), next_latitude.tolist(), next_longitude.tolist())
+        for k, (car, car_distance, car_interpolation, car_battery, car_autonomy, car_latitude, car_longitude) in enumerate(rows):
+            # Under the car lock, the lifecycle and the checkpoints see whole ticks
+            with car.lock:
+                # Written back so join() and the checkpoints see where the car is
+                car.distance = car_distance
+                car.interpolation_val = car_interpolation
+
+                if car.anomalia_forcada:
+                    if car.ride_anomaly():
+                        keep[k] = False
+                        continue
+
+                    # The anomaly may have changed the battery before the move
+                    car.battery_level -= battery_usage[k]
+                    car.autonomy -= distance_traveled[k] / 100 * car.battery_level * 20
+                    battery_level[k] = car.battery_level
+                    autonomy[k] = car.autonomy
+                else:
+                    car.battery_level = car_battery
+                    car.autonomy = car_autonomy
+
+                # Send the car position to Cloud
+                car.send_location(car.ID, (car_latitude, car_longitude), 4 if car.car_return else 3, car.battery_level, car.autonomy)
+
+        self.distance = distance
+        self.battery_level = battery_level
+        self.autonomy = autonomy
+
+        # One fleet batch per tick, sent before the finished rides go on
+        if self.publisher is not None:
+            self.publisher.flush()
+
+        if not keep.all():
+            finished = [ride for ride, k in zip(self.waiters, keep) if not k]
+            self.leave(keep)
+            for ride in finished:
+                ride.set()
+
+    # Vectorized route_index.position, d is the distance along each car's route
+    def position(self, d):
+        first = self.offsets
+        last = self.offsets + self.lengths - 2
+
+        i = np.searchsorted(self.cumulative[:self.used], d + self.route_start, side='right') - 1
+        i = np.minimum(np.maximum(i, first), last)
+
+        segment_length = self.cumulative[i+1] - self.cumulative[i]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = (d + self.route_start - self.cumulative[i]) / segment_length
+        t = np.where(segment_length > 0, np.clip(t, 0.0, 1.0), 0.0)
+
+        base_point = self.points[i]
+        next_point = self.points[i+1]
+        latitude = base_point[:, 1]*(1-t) + next_point[:, 1]*t
+        longitude = base_point[:, 0]*(1-t) + next_point[:, 0]*t
+
+        return latitude, longitude, (i - first) + t
+
+    # Simulation process of the stepper, one step every delta_time. With no car
+    # to move it parks until add() gives it one, so an idle fleet does not
+    # keep the discrete engine busy.
+    def ticks(self, clock):
+        while True:
+            idle = None
+            with self.lock:
+                if not self.cars and not self.pending:
+                    idle = self.idle = waiter()
+            if idle is not None:
+                yield idle
+
+            start = clock.now()
+            self.step()
+            yield max(self.delta_time - (clock.now() - start), 0)
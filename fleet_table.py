@@ -0,0 +1,63 @@
+from threading import Lock
+# ------------------------------------------------------------------------------ #
+# One row per car with what the cloud usually asks about the fleet, kept up to
+# date by the cars themselves every time they send a location or a status, so
+# a snapshot of the whole fleet is one copy under a lock and never walks the
+# cars or waits for them. Served on the PTIN2023/CAR/FLEETSTATUS request topic
+# and on http://localhost:METRICS_PORT/fleet (see metrics.py).
+#
+#   id_car | status_num | status | latitude | longitude | battery | autonomy |
+#   progress (0..1 of the current route, 0 while idle)
+#
+# The position is None until the car sends its first location.
+# ------------------------------------------------------------------------------ #
+
+class fleet_table:
+    def __init__(self, status_names) -> None:
+        self.status_names = status_names
+        self.lock = Lock()
+
+        # id_car -> [status_num, latitude, longitude, battery, autonomy, progress]
+        self.rows = {}
+
+    def add(self, car):
+        with self.lock:
+            self.rows[car.ID] = [car.status, None, None, car.battery_level, car.autonomy, car.progress()]
+
+    def location(self, id, latitude, longitude, battery, autonomy, progress):
+        with self.lock:
+            row = self.rows.get(id)
+            if row is not None:
+                row[1:] = (latitude, longitude, battery, autonomy, progress)
+
+    def status(self, id, status, battery, autonomy, progress):
+        with self.lock:
+            row = self.rows.get(id)
+            if row is not None:
+                row[0] = status
+                row[3:] = (battery, autonomy, progress)
+
+    # Rows of the cars in status_car state (every car when None), by id
+    def snapshot(self, state=None):
+        if state is not None and state not in self.status_names.values():
+            raise ValueError("unknown state " + state)
+
+        with self.lock:
+            rows = [(id, *row) for id, row in self.rows.items()]
+
+        names = self.status_names
+        return [{"id_car":      id,
+                 "status_num":  status,
+                 "status":      names[status],
+                 "latitude":    latitude,
+                 "longitude":   longitude,
+                 "battery":     battery,
+                 "autonomy":    autonomy,
+                 "progress":    progress}
+                for id, status, latitude, longitude, battery, autonomy, progress in sorted(rows)
+                if state is None or names[status] == state]
+
+    # Answer to a PTIN2023/CAR/FLEETSTATUS request or a GET /fleet?state=...
+    def query(self, payload):
+        cars = self.snapshot(payload.get("state"))
+        return {"result": "ok", "count": len(cars), "cars": cars}
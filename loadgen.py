@@ -0,0 +1,252 @@
+import os
+import json
+import time
+import asyncio
+import argparse
+from threading import Lock, Event
+# ---------------------------- #
+import paho.mqtt.client as mqtt
+import wire_format
+import metrics
+from engine import clock, run_async
+from mqtt_fleet import publisher, dispatcher
+from car_states import steps
+# ------------------------------------------------------------------------------ #
+# Load generator: sends one STARTROUTE to each of N cars at a fixed rate and
+# measures the time from every command to the first location of its car, the
+# throughput and how many commands never got an answer.
+#
+#   python3 loadgen.py --cars 1000 --rate 200                   in process, no broker
+#   python3 loadgen.py --cars 100 --broker localhost:1883       simulator already running
+#
+# In process the fleet runs on the asyncio engine with the simulator settings
+# (STEPPER, PUBLISH_QUEUE_SIZE, BATCH_TELEMETRY, ...) and the broker is replaced
+# by a publisher that hands every message to the generator. Every car spends
+# the loading step before its first location, so no latency is below
+# loading / speed: that part is reported apart.
+#
+# Locations are read from UPDATELOCATION, or from the fleet batch when the
+# simulator only sends that one (BATCH_TELEMETRY=1 PER_CAR_TELEMETRY=0), so
+# no location is counted twice.
+# ------------------------------------------------------------------------------ #
+
+location_topic = "PTIN2023/CAR/UPDATELOCATION"
+batch_topic = "PTIN2023/CAR/FLEETLOCATION"
+
+default_route = [[2.176148, 41.421548], [2.16762, 41.412775], [2.166726, 41.412418],
+                 [2.167433, 41.411434], [2.178958, 41.397453], [2.178529, 41.397777]]
+
+class tracker:
+    # Time every command was sent and the latency to the first location of its
+    # car, read from topic (location_topic or batch_topic)
+    def __init__(self, topic) -> None:
+        self.topic = topic
+        self.lock = Lock()
+
+        # id_car -> time the command was sent, until its first location arrives
+        self.pending = {}
+        self.latencies = []
+        self.sent_commands = 0
+        self.locations = 0
+        self.first_sent = None
+        self.last_sent = None
+
+    def sent(self, id):
+        now = time.monotonic()
+        with self.lock:
+            self.pending[id] = now
+            self.sent_commands += 1
+            if self.first_sent is None:
+                self.first_sent = now
+            self.last_sent = now
+
+    def received(self, topic, payload, wire):
+        if topic != self.topic:
+            return
+        if topic == batch_topic:
+            msgs = wire_format.decode_locations(payload, wire)
+        else:
+            msgs = [wire_format.decode_location(payload, wire)]
+
+        now = time.monotonic()
+        with self.lock:
+            self.locations += len(msgs)
+            for msg in msgs:
+                start = self.pending.pop(msg["id_car"], None)
+                if start is not None:
+                    self.latencies.append(now - start)
+
+    def done(self):
+        with self.lock:
+            return not self.pending
+
+    def report(self, elapsed):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            sending = (self.last_sent - self.first_sent) if self.sent_commands > 1 else 0.0
+            lost = len(self.pending)
+
+        def percentile(p):
+            if not latencies:
+                return None
+            return latencies[min(int(p / 100 * len(latencies)), len(latencies) - 1)]
+
+        return {"commands":         self.sent_commands,
+                "command_rate":     self.sent_commands / sending if sending > 0 else None,
+                "answered":         len(latencies),
+                "lost":             lost,
+                "lost_ratio":       lost / self.sent_commands if self.sent_commands else 0.0,
+                "latency":          {"p50": percentile(50), "p90": percentile(90), "p99": percentile(99),
+                                     "max": latencies[-1] if latencies else None},
+                "locations":        self.locations,
+                "location_rate":    self.locations / elapsed if elapsed > 0 else None,
+                "elapsed":          elapsed}
+
+class loopback_publisher(publisher):
+    # Stand-in for the broker: every message the fleet sends goes to the tracker
+    def __init__(self, wire, tracker) -> None:
+        super().__init__(None, None, wire=wire)
+        self.tracker = tracker
+
+    def send(self, topic, payload, qos=0):
+        self.tracker.received(topic, payload, self.wire)
+        return super().send(topic, payload, qos)
+
+def startroute(id, route):
+    return json.dumps({"id_car": id, "order": 1, "route": route}).encode("utf-8")
+
+# ------------------------------------------------------------------------------ #
+
+def run_in_process(args, ids, route, track):
+    # The simulator reads its fleet size when imported
+    os.environ["NUM_CARS"] = str(args.cars)
+    os.environ["FIRST_CAR"] = str(args.first_car)
+    os.environ.setdefault("CAR_SPEED", "0.0005")
+    import virtualCar_anomaly as sim
+
+    sim_clock = clock(args.speed)
+
+    clientS = loopback_publisher(sim.wire, track)
+    if sim.publish_queue_size > 0:
+        clientS.enable_queue(sim.publish_queue_size, sim.publish_max_inflight)
+    if sim.batch_telemetry:
+        clientS.enable_batching(sim.batch_size, sim.batch_interval, sim.per_car_telemetry)
+    if sim.telemetry_deadband:
+        clientS.enable_deadband(sim_clock, sim.telemetry_min_distance, sim.telemetry_battery_delta, sim.telemetry_heartbeat)
+    clientR = dispatcher(None, None)
+
+    cars, stepper = sim.make_fleet(clientS, clientR)
+    processes = [car.lifecycle() for car in cars]
+    if stepper is not None:
+        processes.append(stepper.ticks(sim_clock))
+    elif sim.batch_telemetry:
+        processes.append(clientS.batching())
+
+    async def run():
+        tasks = [asyncio.ensure_future(run_async(process, sim_clock)) for process in processes]
+
+        start = time.monotonic()
+        for i, id in enumerate(ids):
+            # Yield to the fleet at least once per command
+            await asyncio.sleep(max(start + i / args.rate - time.monotonic(), 0))
+            track.sent(id)
+            clientR.dispatch("PTIN2023/CAR/STARTROUTE", startroute(id, route))
+
+        deadline = time.monotonic() + args.timeout
+        while not track.done() and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    asyncio.run(run())
+
+def run_broker(args, ids, route, track):
+    host, _, port = args.broker.partition(":")
+    connected = Event()
+
+    def on_connect(client, userdata, flags, rc):
+        client.subscribe(track.topic)
+        connected.set()
+
+    client = mqtt.Client()
+    client.on_connect = on_connect
+    client.on_message = lambda client, userdata, msg: track.received(msg.topic, msg.payload, args.wire)
+    try:
+        client.connect(host, int(port or 1883), 60)
+    except OSError as error:
+        raise SystemExit("LOADGEN | No s'ha pogut connectar a %s: %s" % (args.broker, error))
+    client.loop_start()
+    if not connected.wait(10):
+        raise SystemExit("LOADGEN | No s'ha pogut connectar a %s" % args.broker)
+
+    start = time.monotonic()
+    for i, id in enumerate(ids):
+        delay = start + i / args.rate - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        track.sent(id)
+        client.publish("PTIN2023/CAR/STARTROUTE", startroute(id, route), args.qos)
+
+    deadline = time.monotonic() + args.timeout
+    while not track.done() and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+    client.loop_stop()
+    client.disconnect()
+
+def main():
+    parser = argparse.ArgumentParser(description="STARTROUTE load generator for the virtual cars")
+    parser.add_argument("--cars", type=int, default=100, help="cars that get a command, one each")
+    parser.add_argument("--first-car", type=int, default=1, help="id of the first car")
+    parser.add_argument("--rate", type=float, default=100, help="commands per second")
+    parser.add_argument("--route", help="JSON file with the route as [[longitude, latitude], ...]")
+    parser.add_argument("--broker", help="host:port of the broker of a running simulator, in process if not given")
+    parser.add_argument("--wire", default=os.environ.get('WIRE_FORMAT', 'json'), help="wire format of the simulator telemetry (with --broker)")
+    parser.add_argument("--qos", type=int, default=0, help="QoS of the commands (with --broker)")
+    parser.add_argument("--speed", type=float, default=float(os.environ.get('TIME_SCALE', 1)), help="TIME_SCALE of the simulator")
+    parser.add_argument("--timeout", type=float, default=60, help="seconds to wait for the last locations after the last command")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    route = default_route
+    if args.route:
+        with open(args.route, encoding="utf-8") as file:
+            route = json.load(file)
+    route = json.dumps(route)
+
+    ids = range(args.first_car, args.first_car + args.cars)
+    only_batch = os.environ.get('BATCH_TELEMETRY', '0') == '1' and os.environ.get('PER_CAR_TELEMETRY', '1') != '1'
+    track = tracker(batch_topic if only_batch else location_topic)
+
+    start = time.monotonic()
+    if args.broker:
+        run_broker(args, ids, route, track)
+    else:
+        run_in_process(args, ids, route, track)
+    results = track.report(time.monotonic() - start)
+
+    # Every car spends the loading step before moving
+    results["loading"] = steps["loading"][2] / args.speed
+    if not args.broker:
+        results["outbound_dropped"] = metrics.outbound_dropped.snapshot()
+        results["outbound_coalesced"] = metrics.outbound_coalesced.snapshot()
+
+    if args.json:
+        print(json.dumps(results))
+        return
+
+    latency = results["latency"]
+    print("LOADGEN | %d comandes, %s comandes/s enviades, %.2f s" % (
+        results["commands"], "%.1f" % results["command_rate"] if results["command_rate"] else "-", results["elapsed"]))
+    if results["answered"]:
+        print("LOADGEN | Latència fins a la primera localització (s): p50 %.3f | p90 %.3f | p99 %.3f | max %.3f (%.3f de càrrega)" % (
+            latency["p50"], latency["p90"], latency["p99"], latency["max"], results["loading"]))
+    print("LOADGEN | Localitzacions rebudes: %d (%.1f/s)" % (results["locations"], results["location_rate"] or 0))
+    print("LOADGEN | Sense resposta: %d (%.2f%%)" % (results["lost"], 100 * results["lost_ratio"]))
+    if not args.broker:
+        print("LOADGEN | Cua de sortida: %d descartats, %d fusionats" % (results["outbound_dropped"], results["outbound_coalesced"]))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,207 @@
+import json
+import time
+import bisect
+from threading import Thread, Lock
+from urllib.parse import urlsplit, parse_qsl
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+# ------------------------------------------------------------------------------ #
+# Health metrics of the simulator, exposed in the Prometheus text format on
+# http://localhost:METRICS_PORT/metrics and/or published as JSON on the stats
+# topic every METRICS_INTERVAL seconds. The same server answers the JSON pages
+# registered in pages, like the fleet table on /fleet (see fleet_table.py).
+#
+#   vcars_ticks_total               car ticks executed (scalar and numpy steppers)
+#   vcars_tick_lag_seconds          how late every timed wake-up of a process ran
+#   vcars_tick_overruns_total       wake-ups later than the whole delay they waited
+#   vcars_publish_seconds           time spent handing a message to the MQTT client
+#   vcars_messages_out_total        published messages per topic
+#   vcars_telemetry_held_total      locations not published by the dead-band policy
+#   vcars_outbound_coalesced_total  queued locations replaced by a newer one of the same car
+#   vcars_outbound_dropped_total    outbound messages dropped by the full queue or the client
+#   vcars_messages_in_total         received commands per topic
+#   vcars_commands_rejected_total   received commands that failed validation
+#   vcars_command_errors_total      received commands whose handler raised an exception
+#   vcars_anomalies_injected_total  anomalies injected by the scenario (see scenarios.py)
+#   vcars_cars                      cars in every status_car state
+#   vcars_publish_queue             messages waiting to be sent, per queue
+#   vcars_route_cache               compiled routes, cache hits and misses, route points
+#                                   received and kept after simplification/resampling
+# ------------------------------------------------------------------------------ #
+
+registry = []
+
+class counter:
+    def __init__(self, name, help, label=None) -> None:
+        self.name = name
+        self.help = help
+        self.label = label
+        self.lock = Lock()
+        self.values = {}
+        registry.append(self)
+
+    def inc(self, key=None, amount=1):
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def collect(self):
+        with self.lock:
+            return dict(self.values)
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s counter" % self.name]
+        for key, value in sorted(self.collect().items(), key=lambda item: str(item[0])):
+            lines.append("%s%s %s" % (self.name, labels(self.label, key), value))
+        return lines
+
+    def snapshot(self):
+        values = self.collect()
+        if self.label is None:
+            return values.get(None, 0)
+        return values
+
+class gauge:
+    # Value read when the metrics are collected. read() returns a number, or a
+    # dict {label value: number} when the gauge has a label.
+    def __init__(self, name, help, read, label=None) -> None:
+        self.name = name
+        self.help = help
+        self.read = read
+        self.label = label
+        registry.append(self)
+
+    def collect(self):
+        value = self.read()
+        if self.label is None:
+            return {None: value}
+        return value
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s gauge" % self.name]
+        for key, value in sorted(self.collect().items(), key=lambda item: str(item[0])):
+            lines.append("%s%s %s" % (self.name, labels(self.label, key), value))
+        return lines
+
+    def snapshot(self):
+        values = self.collect()
+        if self.label is None:
+            return values[None]
+        return values
+
+class histogram:
+    def __init__(self, name, help, buckets) -> None:
+        self.name = name
+        self.help = help
+        self.buckets = list(buckets)
+        self.lock = Lock()
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        registry.append(self)
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def collect(self):
+        with self.lock:
+            return list(self.counts), self.sum
+
+    def render(self):
+        counts, total = self.collect()
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s histogram" % self.name]
+        cumulative = 0
+        for bound, count in zip(self.buckets + ["+Inf"], counts):
+            cumulative += count
+            lines.append('%s_bucket{le="%s"} %d' % (self.name, bound, cumulative))
+        lines.append("%s_sum %s" % (self.name, total))
+        lines.append("%s_count %d" % (self.name, cumulative))
+        return lines
+
+    def snapshot(self):
+        counts, total = self.collect()
+        return {"count": sum(counts), "sum": total, "buckets": dict(zip([str(bound) for bound in self.buckets] + ["+Inf"], counts))}
+
+def labels(label, key):
+    if label is None:
+        return ""
+    return '{%s="%s"}' % (label, str(key).replace("\\", "\\\\").replace('"', '\\"'))
+
+# ------------------------------------------------------------------------------ #
+
+ticks = counter("vcars_ticks_total", "Car ticks executed")
+tick_lag = histogram("vcars_tick_lag_seconds", "Simulated seconds a timed wake-up ran after its due time",
+                     [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5])
+tick_overruns = counter("vcars_tick_overruns_total", "Wake-ups later than the whole delay they waited")
+publish_latency = histogram("vcars_publish_seconds", "Seconds spent handing a message to the MQTT client",
+                            [0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1])
+messages_out = counter("vcars_messages_out_total", "Published messages", "topic")
+messages_in = counter("vcars_messages_in_total", "Received commands", "topic")
+telemetry_held = counter("vcars_telemetry_held_total", "Locations not published by the dead-band policy")
+outbound_coalesced = counter("vcars_outbound_coalesced_total", "Queued locations replaced by a newer one of the same car")
+outbound_dropped = counter("vcars_outbound_dropped_total", "Outbound messages dropped because the queue was full or the client refused them")
+anomalies_injected = counter("vcars_anomalies_injected_total", "Anomalies injected by the scenario", "anomaly")
+commands_rejected = counter("vcars_commands_rejected_total", "Received commands that failed validation", "topic")
+command_errors = counter("vcars_command_errors_total", "Received commands whose handler raised an exception", "topic")
+
+# Called by the engines after every timed wait of delay simulated seconds
+def woke(lag, delay):
+    tick_lag.observe(max(lag, 0.0))
+    if lag > delay:
+        tick_overruns.inc()
+
+def render():
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+def snapshot():
+    return {metric.name: metric.snapshot() for metric in registry}
+
+# ------------------------------------------------------------------------------ #
+
+# Other JSON pages served next to /metrics: path -> function(query parameters)
+# returning the response, it raises ValueError for a bad request
+pages = {}
+
+class metrics_handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path in pages:
+            try:
+                body = json.dumps(pages[url.path](dict(parse_qsl(url.query)))).encode("utf-8")
+            except ValueError as error:
+                self.send_error(400, str(error))
+                return
+            content_type = "application/json"
+        elif url.path == "/metrics":
+            body = render().encode("utf-8")
+            content_type = "text/plain; version=0.0.4; charset=utf-8"
+        else:
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def serve(port, address=""):
+    server = ThreadingHTTPServer((address, port), metrics_handler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# Publishes snapshot() as JSON on topic every interval seconds
+def start_publishing(publisher, interval, topic="PTIN2023/CAR/STATS"):
+    def loop():
+        while True:
+            time.sleep(interval)
+            publisher.publish(topic, json.dumps(snapshot()))
+
+    Thread(target=loop, daemon=True).start()
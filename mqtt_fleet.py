@@ -0,0 +1,424 @@
+import json
+import math
+import time
+from threading import Thread, Lock, Condition, Event
+from collections import deque, OrderedDict
+import paho.mqtt.client as mqtt
+import wire_format
+import commands
+import metrics
+from engine import waiter
+from fleet_log import mqtt_log
+# ------------------------------------------------------------------------------ #
+
+class outbound:
+    # Bounded queue between the cars and the MQTT client. Messages with a key
+    # (the location of a car) are coalesced: a newer one replaces the payload of
+    # the one still queued, keeping its place in the queue, unless a message
+    # without a key was queued after it: then it goes to the tail so it never
+    # overtakes that message. When the queue is full the oldest keyed message
+    # is dropped to make room. Messages without a key (status, anomalies,
+    # batches) are never dropped, if the queue is full of them the producer
+    # waits for room instead.
+    def __init__(self, maxsize) -> None:
+        self.maxsize = maxsize
+        self.cond = Condition()
+        self.seq = 0
+
+        # (topic, key) -> [seq, topic, payload, qos], oldest first
+        self.keyed = OrderedDict()
+        # [seq, topic, payload, qos] without a key, oldest first
+        self.plain = deque()
+
+    def put(self, topic, payload, qos=0, key=None):
+        with self.cond:
+            if key is not None:
+                entry = self.keyed.get((topic, key))
+                if entry is not None:
+                    metrics.outbound_coalesced.inc()
+                    # In place only if no message without a key was queued
+                    # after it, a location never overtakes a later status
+                    if not self.plain or entry[0] > self.plain[-1][0]:
+                        entry[2] = payload
+                        entry[3] = qos
+                        return
+                    del self.keyed[(topic, key)]
+                elif len(self) >= self.maxsize and not self.make_room():
+                    metrics.outbound_dropped.inc()
+                    return
+                self.keyed[(topic, key)] = [self.seq, topic, payload, qos]
+            else:
+                while len(self) >= self.maxsize and not self.make_room():
+                    self.cond.wait()
+                self.plain.append([self.seq, topic, payload, qos])
+
+            self.seq += 1
+            self.cond.notify_all()
+
+    # Drops the oldest keyed message, False if there is none
+    def make_room(self):
+        if not self.keyed:
+            return False
+        self.keyed.popitem(last=False)
+        metrics.outbound_dropped.inc()
+        return True
+
+    # (topic, payload, qos) of the oldest message, waits if there is none
+    def get(self):
+        with self.cond:
+            while not len(self):
+                self.cond.wait()
+
+            if self.keyed:
+                key, entry = next(iter(self.keyed.items()))
+                if not self.plain or entry[0] < self.plain[0][0]:
+                    del self.keyed[key]
+                else:
+                    entry = self.plain.popleft()
+            else:
+                entry = self.plain.popleft()
+
+            self.cond.notify_all()
+        return entry[1:]
+
+    # Waits until everything queued was handed to the client, or timeout
+    def join(self, timeout=None):
+        with self.cond:
+            return self.cond.wait_for(lambda: not len(self), timeout)
+
+    def __len__(self):
+        return len(self.keyed) + len(self.plain)
+
+# ------------------------------------------------------------------------------ #
+
+class publisher:
+    # Long-lived MQTT client shared by every car of the process. The network
+    # loop runs in its own thread and paho reconnects on its own, so a
+    # publish only costs the payload instead of a full TCP + MQTT handshake.
+    # With address=None nothing is sent, which is used to replay captures
+    # without a broker.
+    def __init__(self, address, port, keepalive=60, wire="json") -> None:
+        self.connected = Event()
+
+        # Bounded outbound queue, see enable_queue()
+        self.outbound = None
+
+        # Optional recorder.recorder that captures every published message
+        self.recorder = None
+
+        # Encoding of UPDATELOCATION, UPDATESTATUS and the fleet batch
+        wire_format.check_format(wire)
+        self.wire = wire
+
+        # Dead-band telemetry, see enable_deadband()
+        self.deadband = None
+
+        # Fleet telemetry batching, see enable_batching()
+        self.per_car = True
+        self.batch = None
+        self.batch_lock = Lock()
+
+        self.client = None
+        if address is None:
+            return
+
+        self.client = mqtt.Client()
+        self.client.on_connect = self.on_connect
+        self.client.on_disconnect = self.on_disconnect
+        self.client.reconnect_delay_set(min_delay=1, max_delay=30)
+
+        self.client.connect_async(address, port, keepalive)
+        self.client.loop_start()
+
+    def on_connect(self, client, userdata, flags, rc):
+        if rc == 0:
+            self.connected.set()
+            mqtt_log.info("PUBLISHER | Cloud connectat amb èxit.")
+        else:
+            mqtt_log.error("PUBLISHER | Error de connexió: %s", mqtt.connack_string(rc))
+
+    def on_disconnect(self, client, userdata, rc):
+        self.connected.clear()
+        if rc != 0:
+            mqtt_log.warning("PUBLISHER | Connexió perduda, reconnectant...")
+
+    # key marks messages that can be coalesced in the outbound queue, the
+    # newest message with the same topic and key is the only one sent
+    def publish(self, topic, payload, qos=0, key=None):
+        if self.outbound is not None:
+            self.outbound.put(topic, payload, qos, key)
+        else:
+            self.send(topic, payload, qos)
+
+    def send(self, topic, payload, qos=0):
+        metrics.messages_out.inc(topic)
+        if self.recorder is not None:
+            self.recorder.record("out", topic, payload)
+        if self.client is not None:
+            start = time.perf_counter()
+            info = self.client.publish(topic, payload, qos)
+            metrics.publish_latency.observe(time.perf_counter() - start)
+            return info
+
+    # Every message goes through a queue of at most maxsize messages, drained
+    # by its own thread, so the cars never wait for the broker. The sender
+    # waits while the connection is down and keeps at most max_inflight
+    # messages handed to paho and not yet written to the socket.
+    def enable_queue(self, maxsize=10000, max_inflight=100):
+        self.outbound = outbound(maxsize)
+        self.max_inflight = max_inflight
+
+        Thread(target=self.run_sender, daemon=True).start()
+
+    def run_sender(self):
+        inflight = deque()
+        while True:
+            topic, payload, qos = self.outbound.get()
+
+            if self.client is not None:
+                self.connected.wait()
+                while inflight and (inflight[0].is_published() or not self.connected.is_set()):
+                    inflight.popleft()
+                while len(inflight) >= self.max_inflight and self.connected.is_set():
+                    inflight[0].wait_for_publish(0.1)
+                    while inflight and (inflight[0].is_published() or not self.connected.is_set()):
+                        inflight.popleft()
+
+            info = self.send(topic, payload, qos)
+            if info is not None:
+                if info.rc == mqtt.MQTT_ERR_SUCCESS:
+                    inflight.append(info)
+                else:
+                    metrics.outbound_dropped.inc()
+
+    # Messages waiting to be sent: paho's outgoing packets and the fleet batch
+    def queue_depth(self):
+        depth = {"mqtt": 0, "batch": 0, "outbound": 0}
+        if self.outbound is not None:
+            depth["outbound"] = len(self.outbound)
+        if self.client is not None:
+            depth["mqtt"] = len(getattr(self.client, "_out_packet", ()))
+        if self.batch is not None:
+            depth["batch"] = len(self.batch)
+        return depth
+
+    # Collect the position updates of every car and publish them as a single
+    # array on the fleet topic, at most batch_size cars per message. The batch
+    # is flushed on the simulated clock, so a message holds the same ticks
+    # whatever the engine and the time scale: once per tick by the fleet
+    # stepper, or by batching() when the cars move themselves. per_car keeps
+    # UPDATELOCATION as well.
+    def enable_batching(self, batch_size=500, flush_interval=0.33, per_car=True, topic="PTIN2023/CAR/FLEETLOCATION"):
+        self.batch = []
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.batch_topic = topic
+        self.per_car = per_car
+
+        # Released by the first location of an empty batch, see batching()
+        self.batch_ready = None
+
+    # Dead-band telemetry: a location is only published when the car moved more
+    # than min_distance meters, its battery changed by battery_delta or more,
+    # its status_num changed, or heartbeat simulated seconds passed since the
+    # last one. The last location held back for a car is published before its
+    # next status update, so the cloud always sees where a ride ended.
+    def enable_deadband(self, clock, min_distance=25.0, battery_delta=1.0, heartbeat=5.0):
+        self.clock = clock
+        self.min_distance = min_distance
+        self.battery_delta = battery_delta
+        self.heartbeat = heartbeat
+
+        # id_car -> (time, latitude, longitude, status_num, battery) last published
+        self.deadband = {}
+        # id_car -> last location held back
+        self.held = {}
+
+    def changed(self, msg):
+        location = msg["location_act"]
+        last = self.deadband.get(msg["id_car"])
+        now = self.clock.now()
+
+        if last is not None:
+            at, latitude, longitude, status_num, battery = last
+            # Equirectangular approximation, plenty for a few meters
+            dy = (location["latitude"] - latitude) * 110540
+            dx = (location["longitude"] - longitude) * 111320 * math.cos(math.radians(latitude))
+            if (now - at < self.heartbeat and status_num == msg["status_num"]
+                    and abs(battery - msg["battery"]) < self.battery_delta
+                    and dx*dx + dy*dy < self.min_distance*self.min_distance):
+                return False
+
+        self.deadband[msg["id_car"]] = (now, location["latitude"], location["longitude"], msg["status_num"], msg["battery"])
+        return True
+
+    def publish_location(self, msg):
+        if self.deadband is not None:
+            if not self.changed(msg):
+                self.held[msg["id_car"]] = msg
+                metrics.telemetry_held.inc()
+                return
+            self.held.pop(msg["id_car"], None)
+
+        self.send_location(msg)
+
+    def send_location(self, msg):
+        if self.per_car:
+            self.publish("PTIN2023/CAR/UPDATELOCATION", wire_format.encode_location(msg, self.wire), key=msg["id_car"])
+
+        if self.batch is not None:
+            with self.batch_lock:
+                self.batch.append(msg)
+                ready, self.batch_ready = self.batch_ready, None
+                batch = None
+                if len(self.batch) >= self.batch_size:
+                    batch, self.batch = self.batch, []
+            if ready is not None:
+                ready.set()
+            if batch is not None:
+                self.publish(self.batch_topic, wire_format.encode_locations(batch, self.wire))
+
+    def publish_status(self, msg):
+        if self.deadband is not None:
+            held = self.held.pop(msg["id_car"], None)
+            if held is not None:
+                location = held["location_act"]
+                self.deadband[held["id_car"]] = (self.clock.now(), location["latitude"], location["longitude"], held["status_num"], held["battery"])
+                self.send_location(held)
+
+        self.publish("PTIN2023/CAR/UPDATESTATUS", wire_format.encode_status(msg, self.wire))
+
+    def flush(self):
+        with self.batch_lock:
+            if not self.batch:
+                return
+            batch, self.batch = self.batch, []
+        self.publish(self.batch_topic, wire_format.encode_locations(batch, self.wire))
+
+    # Simulation process that flushes the batch half a flush_interval after
+    # its first location, between two ticks of the car that sent it, so no
+    # car is twice in a message when flush_interval is the tick. It waits for
+    # a location while the batch is empty, so an idle fleet does not keep the
+    # discrete engine busy.
+    def batching(self):
+        while True:
+            ready = None
+            with self.batch_lock:
+                if not self.batch:
+                    ready = self.batch_ready = waiter()
+            if ready is not None:
+                yield ready
+                yield self.flush_interval / 2
+            else:
+                yield self.flush_interval
+            self.flush()
+
+    # Sends what is still batched or queued and disconnects
+    def stop(self, timeout=5):
+        self.flush()
+        if self.outbound is not None:
+            self.outbound.join(timeout)
+        if self.client is not None:
+            self.client.disconnect()
+            self.client.loop_stop()
+
+# ------------------------------------------------------------------------------ #
+
+class dispatcher:
+    # Single subscriber for the whole process. It only listens to the command
+    # topics, decodes and validates every message once (see commands.py) and
+    # hands it to the car registered under "id_car", so inbound work no longer
+    # grows with the fleet size. Fleet-wide requests, not addressed to a car,
+    # are answered by the functions registered with query().
+    handlers = {
+        "PTIN2023/CAR/STARTROUTE":  "on_startroute",
+        "PTIN2023/CAR/ANOMALIA":    "on_anomalia"
+    }
+
+    def __init__(self, address, port, keepalive=60) -> None:
+        self.address = address
+        self.port = port
+        self.keepalive = keepalive
+
+        # id_car -> vcar
+        self.cars = {}
+
+        # topic -> (handler, publisher) of the fleet-wide requests
+        self.queries = {}
+
+        # Optional recorder.recorder that captures every received command
+        self.recorder = None
+
+        self.client = mqtt.Client()
+        self.client.on_connect = self.on_connect
+        self.client.on_message = self.on_message
+        self.client.reconnect_delay_set(min_delay=1, max_delay=30)
+
+    def register(self, car):
+        self.cars[car.ID] = car
+
+    # handler(payload) returns the response to a request on topic, published as
+    # JSON with publisher. It raises ValueError when the request makes no sense.
+    def query(self, topic, handler, publisher):
+        self.queries[topic] = (handler, publisher)
+
+    def on_connect(self, client, userdata, flags, rc):
+        if rc == 0:
+            mqtt_log.info("DISPATCHER | Cloud connectat amb èxit. Cotxes: %d", len(self.cars))
+        # Subscribe again on every (re)connection
+        client.subscribe([(topic, 0) for topic in list(self.handlers) + list(self.queries)])
+
+    def on_message(self, client, userdata, msg):
+        self.dispatch(msg.topic, msg.payload)
+
+    # Also called directly, without a broker, to replay captured commands
+    def dispatch(self, topic, raw):
+        handler = self.handlers.get(topic)
+        if handler is None and topic not in self.queries:
+            return
+
+        metrics.messages_in.inc(topic)
+        if self.recorder is not None:
+            self.recorder.record("in", topic, raw)
+
+        try:
+            payload = commands.parse(topic, raw)
+        except commands.command_error as error:
+            metrics.commands_rejected.inc(topic)
+            mqtt_log.error("FORMAT ERROR! --> %s (%s)", topic, error)
+            return
+
+        # Nothing raised by a car or a query may reach paho, it would stop the
+        # only subscriber of the fleet
+        try:
+            if handler is None:
+                self.answer(topic, payload)
+                return
+
+            car = self.cars.get(payload["id_car"])
+            if car is not None:
+                getattr(car, handler)(payload)
+        except Exception:
+            metrics.command_errors.inc(topic)
+            mqtt_log.exception("DISPATCHER | Error processant %s", topic)
+
+    def answer(self, topic, payload):
+        handler, publisher = self.queries[topic]
+        try:
+            response = handler(payload)
+        except ValueError as error:
+            metrics.commands_rejected.inc(topic)
+            response = {"result": "error", "description": str(error)}
+
+        if "request_id" in payload:
+            response["request_id"] = payload["request_id"]
+        publisher.publish(payload.get("reply_to") or topic + "/RESPONSE", json.dumps(response))
+
+    def start(self):
+        self.client.connect_async(self.address, self.port, self.keepalive)
+        self.client.loop_forever(retry_first_connection=True)
+
+    # Same as start() but the network loop runs in paho's own thread
+    def start_background(self):
+        self.client.connect_async(self.address, self.port, self.keepalive)
+        self.client.loop_start()
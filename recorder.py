@@ -0,0 +1,57 @@
+import json
+import time
+import base64
+from threading import Lock
+# ------------------------------------------------------------------------------ #
+# Capture of the MQTT traffic of the simulator, one JSON object per line:
+#
+#   {"t": 12.54, "dir": "in",  "topic": "PTIN2023/CAR/STARTROUTE", "payload": "{...}"}
+#   {"t": 12.87, "dir": "out", "topic": "PTIN2023/CAR/UPDATELOCATION", "payload": "{...}"}
+#
+# "t" is the simulated time in seconds since the simulator started. Binary
+# payloads (struct/msgpack wire formats) are stored in base64 with "b64": true.
+# ------------------------------------------------------------------------------ #
+
+class recorder:
+    def __init__(self, path, clock) -> None:
+        self.clock = clock
+        self.lock = Lock()
+        self.file = open(path, "a", encoding="utf-8", buffering=1 << 16)
+        self.flushed = time.monotonic()
+
+    def record(self, direction, topic, payload):
+        line = {"t": round(self.clock.now(), 6), "dir": direction, "topic": topic}
+
+        if isinstance(payload, str):
+            line["payload"] = payload
+        else:
+            try:
+                line["payload"] = payload.decode("utf-8")
+            except UnicodeDecodeError:
+                line["payload"] = base64.b64encode(payload).decode("ascii")
+                line["b64"] = True
+
+        with self.lock:
+            self.file.write(json.dumps(line) + "\n")
+
+            # Buffered, but never more than a second behind
+            if time.monotonic() - self.flushed > 1:
+                self.file.flush()
+                self.flushed = time.monotonic()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+def read_capture(path):
+    with open(path, encoding="utf-8") as file:
+        for line in file:
+            if not line.strip():
+                continue
+
+            entry = json.loads(line)
+            if entry.pop("b64", False):
+                entry["payload"] = base64.b64decode(entry["payload"])
+            else:
+                entry["payload"] = entry["payload"].encode("utf-8")
+            yield entry
@@ -0,0 +1,86 @@
+import argparse
+import asyncio
+from collections import Counter
+# ---------------------------- #
+import virtualCar_anomaly as sim
+from engine import clock, virtual_clock, run_async
+from mqtt_fleet import publisher, dispatcher
+from recorder import recorder, read_capture
+# ------------------------------------------------------------------------------ #
+# Replays the commands of a capture (RECORD_FILE of the simulator) into a fresh
+# fleet without any broker, at the given speed. With --speed 0 the run uses the
+# discrete event engine and is fully deterministic, so the outputs of two
+# versions of the simulator can be compared line by line.
+#
+#   NUM_CARS=20 CAR_SPEED=0.0005 python3 replay.py capture.jsonl --output out.jsonl
+# ------------------------------------------------------------------------------ #
+
+class counting_publisher(publisher):
+    def __init__(self, wire) -> None:
+        super().__init__(None, None, wire=wire)
+        self.sent = Counter()
+
+    def send(self, topic, payload, qos=0):
+        self.sent[topic] += 1
+        return super().send(topic, payload, qos)
+
+# Simulation process that delivers the captured commands at their timestamps
+def injector(commands, clientR, sim_clock):
+    for entry in commands:
+        delay = entry["t"] - sim_clock.now()
+        if delay > 0:
+            yield delay
+        clientR.dispatch(entry["topic"], entry["payload"])
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a capture of the virtual cars without a broker")
+    parser.add_argument("capture", help="JSONL capture written with RECORD_FILE")
+    parser.add_argument("--speed", type=float, default=0, help="simulated seconds per real second, 0 = as fast as possible")
+    parser.add_argument("--until", type=float, help="simulated seconds to run, by default up to the last line of the capture")
+    parser.add_argument("--output", help="write the replayed traffic to this JSONL file")
+    args = parser.parse_args()
+
+    capture = list(read_capture(args.capture))
+    commands = [entry for entry in capture if entry["dir"] == "in"]
+    captured = Counter(entry["topic"] for entry in capture if entry["dir"] == "out")
+    # The capture rounds the times to the microsecond, so the last event can be
+    # just past its own timestamp: run a millisecond longer
+    until = args.until if args.until is not None else max((entry["t"] for entry in capture), default=0) + 1e-3
+
+    sim_clock = virtual_clock() if args.speed == 0 else clock(args.speed)
+
+    clientS = counting_publisher(sim.wire)
+    if sim.telemetry_deadband:
+        clientS.enable_deadband(sim_clock, sim.telemetry_min_distance, sim.telemetry_battery_delta, sim.telemetry_heartbeat)
+    clientR = dispatcher(None, None)
+    if args.output:
+        clientS.recorder = clientR.recorder = recorder(args.output, sim_clock)
+
+    cars, stepper = sim.make_fleet(clientS, clientR)
+
+    processes = [car.lifecycle() for car in cars]
+    if stepper is not None:
+        processes.append(stepper.ticks(sim_clock))
+    processes.append(injector(commands, clientR, sim_clock))
+
+    if args.speed == 0:
+        for process in processes:
+            sim_clock.spawn(process)
+        sim_clock.run(until, wait_external=False)
+    else:
+        async def run():
+            tasks = [asyncio.ensure_future(run_async(process, sim_clock)) for process in processes]
+            await asyncio.wait(tasks, timeout=until / args.speed)
+            for task in tasks:
+                task.cancel()
+        asyncio.run(run())
+
+    if args.output:
+        clientS.recorder.close()
+
+    print("REPLAY | %d comandes, %.2f s simulats" % (len(commands), until))
+    for topic in sorted(set(captured) | set(clientS.sent)):
+        print("%-32s captura: %8d | replay: %8d" % (topic, captured[topic], clientS.sent[topic]))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,258 @@
+import math
+import hashlib
+from array import array
+from itertools import chain, accumulate, islice
+from threading import Lock
+from bisect import bisect_right
+from collections import OrderedDict
+# ---------------------------- #
+from wire_format import loads
+# ------------------------------------------------------------------------------ #
+
+# [[longitude, latitude], ...] as received from the cloud into one flat array of
+# doubles, lon0 lat0 lon1 lat1 ... Raises ValueError if it is not a list of pairs.
+def pack_points(coordinates):
+    if not isinstance(coordinates, (list, tuple)) or not coordinates:
+        raise ValueError("route must be a non-empty list of [longitude, latitude]")
+    try:
+        if set(map(len, coordinates)) != {2}:
+            raise ValueError("every point of the route must be [longitude, latitude]")
+        return array('d', [value for point in coordinates for value in point])
+    except TypeError:
+        raise ValueError("every point of the route must be [longitude, latitude]") from None
+    except OverflowError:
+        raise ValueError("every coordinate of the route must fit in a double") from None
+
+class route_index:
+    # Route compiled once, when it is received, into cumulative arc lengths.
+    # The position at any distance along the route is then found by bisection,
+    # so the per-tick cost does not depend on the geometry of the segments.
+    # Routes are immutable and shared by every car that drives them.
+    def __init__(self, coordinates, cumulative=None) -> None:
+        # Flat array of doubles, see pack_points(). The arc lengths are computed
+        # straight from the pairs when they are given, with no extra copy.
+        if isinstance(coordinates, array):
+            self.points = coordinates
+            pairs = None
+        else:
+            self.points = pack_points(coordinates)
+            pairs = coordinates
+
+        if cumulative is None:
+            if pairs is None:
+                values = iter(self.points.tolist())
+                pairs = list(zip(values, values))
+            cumulative = accumulate(map(math.dist, pairs, islice(pairs, 1, None)), initial=0.0)
+
+        self.cumulative = array('d', cumulative)
+        self.length = self.cumulative[-1] if self.cumulative else 0.0
+
+        # Points of the route as it was received and left by simplify(), before
+        # resample()
+        self.received = len(self)
+        self.simplified = len(self)
+
+        # The same route driven the other way, built on the first reversed()
+        self.opposite = None
+
+    def __len__(self):
+        return len(self.points) // 2
+
+    # (longitude, latitude) of the i-th point
+    def point(self, i):
+        if i < 0:
+            i += len(self)
+        return (self.points[2*i], self.points[2*i+1])
+
+    # ((longitude, latitude), ...), only built when asked for
+    @property
+    def coordinates(self):
+        return tuple(self.point(i) for i in range(len(self)))
+
+    # Same route driven the other way, without computing any square root again.
+    # Both directions point to each other, so going back and forth never copies.
+    def reversed(self):
+        if self.opposite is None:
+            points = array('d', self.points)
+            points.reverse()
+            # Reversing the flat array also swaps longitude and latitude, swap back
+            points[0::2], points[1::2] = points[1::2], points[0::2]
+            cumulative = array('d', map(self.length.__sub__, reversed(self.cumulative)))
+            opposite = route_index(points, cumulative)
+            opposite.received = self.received
+            opposite.simplified = self.simplified
+            opposite.opposite = self
+            self.opposite = opposite
+        return self.opposite
+
+    # First points of the route, reusing its arc lengths
+    def truncated(self, points):
+        points = max(points, 0)
+        return route_index(self.points[:2*points], self.cumulative[:points])
+
+    # Segment that contains the distance d and how far along it we are (0..1)
+    def segment(self, d):
+        i = min(max(bisect_right(self.cumulative, d) - 1, 0), len(self) - 2)
+        segment_length = self.cumulative[i+1] - self.cumulative[i]
+        if segment_length <= 0:
+            return i, 0.0
+        return i, min(max((d - self.cumulative[i]) / segment_length, 0.0), 1.0)
+
+    # (latitude, longitude, interpolation_val) at distance d from the start
+    def position(self, d):
+        points = self.points
+        if len(points) < 4:
+            return (points[1], points[0], 0)
+
+        i, t = self.segment(d)
+        lon1, lat1, lon2, lat2 = points[2*i:2*i+4]
+
+        latitude = lat1*(1-t) + lat2*t
+        longitude = lon1*(1-t) + lon2*t
+
+        return (latitude, longitude, i + t)
+
+# ------------------------------------------------------------------------------ #
+# Optional clean-up of the routes when they are received, before they are
+# compiled. Tolerance and step are in meters, with the same equirectangular
+# approximation as the dead-band policy (mqtt_fleet.py), plenty for a city.
+
+# Meters per degree of longitude and latitude around the route
+def meters_per_degree(latitude):
+    mean = sum(latitude) / len(latitude)
+    return 111320 * math.cos(math.radians(mean)), 110540
+
+# Douglas-Peucker: drops the points that are closer than tolerance meters to
+# the segment joining the points kept around them. First and last are kept.
+def simplify(points, tolerance):
+    n = len(points) // 2
+    if tolerance <= 0 or n < 3:
+        return points
+
+    longitude, latitude = points[0::2].tolist(), points[1::2].tolist()
+    kx, ky = meters_per_degree(latitude)
+    x = [value * kx for value in longitude]
+    y = [value * ky for value in latitude]
+
+    keep = bytearray(n)
+    keep[0] = keep[-1] = 1
+    tolerance2 = tolerance * tolerance
+
+    # Without recursion, a route of thousands of points would hit the limit
+    pending = [(0, n - 1)]
+    while pending:
+        first, last = pending.pop()
+        ax, ay = x[first], y[first]
+        dx, dy = x[last] - ax, y[last] - ay
+        norm = dx*dx + dy*dy
+
+        worst, farthest = tolerance2, None
+        for i in range(first + 1, last):
+            px, py = x[i] - ax, y[i] - ay
+            # Distance to the segment, not the line, so loops that end where
+            # they started are simplified too
+            if norm > 0:
+                t = min(max((px*dx + py*dy) / norm, 0.0), 1.0)
+                px -= t * dx
+                py -= t * dy
+            distance = px*px + py*py
+            if distance > worst:
+                worst, farthest = distance, i
+
+        if farthest is not None:
+            keep[farthest] = 1
+            pending.append((first, farthest))
+            pending.append((farthest, last))
+
+    return array('d', chain.from_iterable((longitude[i], latitude[i]) for i in range(n) if keep[i]))
+
+# One point every step meters along the route, plus the last one
+def resample(points, step):
+    n = len(points) // 2
+    if step <= 0 or n < 2:
+        return points
+
+    longitude, latitude = points[0::2].tolist(), points[1::2].tolist()
+    kx, ky = meters_per_degree(latitude)
+
+    resampled = array('d', (longitude[0], latitude[0]))
+    travelled = 0.0
+    next_point = step
+    for i in range(n - 1):
+        dlon = longitude[i+1] - longitude[i]
+        dlat = latitude[i+1] - latitude[i]
+        length = math.hypot(dlon * kx, dlat * ky)
+        while travelled + length > next_point:
+            t = (next_point - travelled) / length
+            resampled.extend((longitude[i] + t*dlon, latitude[i] + t*dlat))
+            next_point += step
+        travelled += length
+
+    resampled.extend((longitude[-1], latitude[-1]))
+    return resampled
+
+# ------------------------------------------------------------------------------ #
+
+class route_cache:
+    # Bounded LRU of compiled routes keyed by a hash of the route as received,
+    # so when the cloud sends the same warehouse-to-hive route to many cars it
+    # is parsed and compiled once and every car shares the same route_index.
+    # The route can arrive as a JSON string or already decoded as a list.
+    # Routes are simplified (tolerance) and resampled (step) before compiling
+    # them when those are above 0, see simplify() and resample().
+    def __init__(self, maxsize=256, tolerance=0.0, step=0.0) -> None:
+        self.maxsize = maxsize
+        self.tolerance = tolerance
+        self.step = step
+        self.lock = Lock()
+        self.routes = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # Points received and compiled, over every route compiled
+        self.points_in = 0
+        self.points_out = 0
+
+    def get(self, raw):
+        points = None
+        if isinstance(raw, str):
+            raw = raw.encode("utf-8")
+        elif not isinstance(raw, bytes):
+            points = pack_points(raw)
+            raw = points.tobytes()
+        key = hashlib.blake2b(raw, digest_size=16).digest()
+
+        with self.lock:
+            route = self.routes.get(key)
+            if route is not None:
+                self.routes.move_to_end(key)
+                self.hits += 1
+                return route
+            self.misses += 1
+
+        if points is None:
+            coordinates = loads(raw)
+            if self.tolerance <= 0 and self.step <= 0:
+                # Packed and compiled in one go from the decoded pairs
+                route = route_index(coordinates)
+            else:
+                points = pack_points(coordinates)
+        if points is not None:
+            simplified = simplify(points, self.tolerance)
+            route = route_index(resample(simplified, self.step))
+            route.received = len(points) // 2
+            route.simplified = len(simplified) // 2
+        received = route.received
+
+        with self.lock:
+            # Another thread may have compiled it meanwhile, keep the first one
+            if key not in self.routes:
+                self.points_in += received
+                self.points_out += len(route)
+            route = self.routes.setdefault(key, route)
+            self.routes.move_to_end(key)
+            while len(self.routes) > self.maxsize:
+                self.routes.popitem(last=False)
+        return route
+
+    def __len__(self):
+        return len(self.routes)
@@ -0,0 +1,108 @@
+import json
+import random
+# ---------------------------- #
+import metrics
+from car_states import anomalies
+from fleet_log import fleet_log
+# ------------------------------------------------------------------------------ #
+# Fleet-wide anomaly injection. A scenario is a JSON file with a list of rules:
+#
+#   {"seed": 42,
+#    "rules": [
+#       {"anomaly": "set_battery_10", "rate": 0.02, "per": 3600, "state": "delivering"},
+#       {"anomaly": "breakdown", "at": 300, "car": 10}
+#    ]}
+#
+#   scripted        "at" simulated seconds, to "car" or to every car of "cars"
+#   probabilistic   every car (in status_car "state" if given) gets the anomaly
+#                   with probability "rate" every "per" seconds (default one
+#                   hour), optionally only between "from" and "until"
+#
+# The anomalies are sent through the dispatcher as PTIN2023/CAR/ANOMALIA
+# commands, so they are validated and recorded like the ones from the cloud,
+# and with the same seed the discrete engine injects exactly the same ones.
+# ------------------------------------------------------------------------------ #
+
+class scenario:
+    def __init__(self, rules, seed=0, interval=1.0) -> None:
+        self.rng = random.Random(seed)
+
+        # Seconds between two draws of the probabilistic rules
+        self.interval = interval
+
+        # (at, car, anomaly), in time order
+        self.scripted = []
+        # (anomaly, probability per interval, state, from, until)
+        self.rates = []
+
+        for rule in rules:
+            anomaly = rule.get("anomaly")
+            if anomaly not in anomalies:
+                raise ValueError("Unknown anomaly in scenario rule: %s" % rule)
+
+            if "at" in rule:
+                cars = rule.get("cars", [rule["car"]] if "car" in rule else None)
+                if not cars:
+                    raise ValueError("Scripted scenario rule without car: %s" % rule)
+                for car in cars:
+                    self.scripted.append((float(rule["at"]), int(car), anomaly))
+
+            elif "rate" in rule:
+                rate = float(rule["rate"])
+                if not 0 <= rate <= 1:
+                    raise ValueError("Scenario rate must be between 0 and 1: %s" % rule)
+                probability = 1 - (1 - rate) ** (interval / float(rule.get("per", 3600)))
+                self.rates.append((anomaly, probability, rule.get("state"), float(rule.get("from", 0)), float(rule.get("until", "inf"))))
+
+            else:
+                raise ValueError("Scenario rule needs \"at\" or \"rate\": %s" % rule)
+
+        self.scripted.sort()
+
+    # Probabilistic rules without "until" keep drawing forever
+    def endless(self):
+        return any(end == float("inf") for _, _, _, _, end in self.rates)
+
+    @classmethod
+    def load(cls, path, seed=None, interval=1.0):
+        with open(path, encoding="utf-8") as file:
+            data = json.load(file)
+        return cls(data["rules"], data.get("seed", 0) if seed is None else seed, interval)
+
+    def inject(self, clientR, car, anomaly):
+        metrics.anomalies_injected.inc(anomaly)
+        fleet_log.info("SCENARIO | CAR: %d | %s", car, anomaly)
+        clientR.dispatch("PTIN2023/CAR/ANOMALIA", json.dumps({"id_car": car, "hehe": anomaly}).encode("utf-8"))
+
+    # Simulation process that injects the anomalies of the scenario into cars,
+    # status_names is the status_car table of the simulator
+    def process(self, cars, clientR, clock, status_names):
+        scripted = list(self.scripted)
+        next_draw = clock.now() + self.interval
+        last_draw = max((end for _, _, _, _, end in self.rates), default=0)
+
+        while scripted or next_draw < last_draw:
+            now = clock.now()
+
+            while scripted and scripted[0][0] <= now:
+                _, car, anomaly = scripted.pop(0)
+                self.inject(clientR, car, anomaly)
+
+            if self.rates and now >= next_draw:
+                next_draw += self.interval
+                for anomaly, probability, state, start, end in self.rates:
+                    if not start <= now < end:
+                        continue
+                    for car in cars:
+                        # Broken down cars and cars with an anomaly pending are left alone
+                        if car.state is None or car.anomalia_forcada:
+                            continue
+                        if state is not None and status_names[car.status] != state:
+                            continue
+                        if self.rng.random() < probability:
+                            self.inject(clientR, car.ID, anomaly)
+
+            wake = next_draw if next_draw < last_draw else float("inf")
+            if scripted:
+                wake = min(wake, scripted[0][0])
+            yield max(wake - clock.now(), 0)
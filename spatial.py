@@ -0,0 +1,153 @@
+import math
+import heapq
+from threading import Lock
+# ------------------------------------------------------------------------------ #
+# Last known position of every car, bucketed in square cells of cell meters so
+# "which cars are near here" only looks at the cells around the point instead
+# of the whole fleet. Cars are moved between cells as their locations are sent,
+# one dict update per tick. Distances use the same equirectangular
+# approximation as the dead-band policy (mqtt_fleet.py), fixed at the latitude
+# of the first position, plenty for a city.
+# ------------------------------------------------------------------------------ #
+
+class grid:
+    def __init__(self, cell=500.0) -> None:
+        self.cell = cell
+        self.lock = Lock()
+
+        # (row, column) -> {id_car: (latitude, longitude)}
+        self.cells = {}
+        # id_car -> (row, column)
+        self.cars = {}
+
+        # Meters per degree of latitude and longitude
+        self.ky = 110540
+        self.kx = None
+
+    def key(self, latitude, longitude):
+        return (math.floor(latitude * self.ky / self.cell), math.floor(longitude * self.kx / self.cell))
+
+    def move(self, id, latitude, longitude):
+        with self.lock:
+            if self.kx is None:
+                self.kx = 111320 * math.cos(math.radians(latitude))
+
+            key = self.key(latitude, longitude)
+            old = self.cars.get(id)
+            if old != key:
+                if old is not None:
+                    cell = self.cells[old]
+                    del cell[id]
+                    if not cell:
+                        del self.cells[old]
+                self.cars[id] = key
+            self.cells.setdefault(key, {})[id] = (latitude, longitude)
+
+    def __len__(self):
+        return len(self.cars)
+
+    # (distance in meters, id_car, latitude, longitude) of the cars in the given
+    # cells that accept(id_car) and are at most radius meters away
+    def scan(self, cells, latitude, longitude, radius, accept):
+        found = []
+        for key in cells:
+            for id, (lat, lon) in self.cells.get(key, {}).items():
+                if accept is not None and not accept(id):
+                    continue
+                distance = math.hypot((lat - latitude) * self.ky, (lon - longitude) * self.kx)
+                if distance <= radius:
+                    found.append((distance, id, lat, lon))
+        return found
+
+    # Cells at exactly ring cells (Chebyshev distance) from center
+    @staticmethod
+    def ring(center, ring):
+        row, column = center
+        if ring == 0:
+            return [center]
+        cells = []
+        for c in range(column - ring, column + ring + 1):
+            cells.append((row - ring, c))
+            cells.append((row + ring, c))
+        for r in range(row - ring + 1, row + ring):
+            cells.append((r, column - ring))
+            cells.append((r, column + ring))
+        return cells
+
+    # Every car at most radius meters away, nearest first
+    def within(self, latitude, longitude, radius, accept=None):
+        with self.lock:
+            if self.kx is None:
+                return []
+            row0, column0 = self.key(latitude - radius / self.ky, longitude - radius / self.kx)
+            row1, column1 = self.key(latitude + radius / self.ky, longitude + radius / self.kx)
+
+            if (row1 - row0 + 1) * (column1 - column0 + 1) > len(self.cells):
+                cells = [key for key in self.cells if row0 <= key[0] <= row1 and column0 <= key[1] <= column1]
+            else:
+                cells = [(r, c) for r in range(row0, row1 + 1) for c in range(column0, column1 + 1)]
+            return sorted(self.scan(cells, latitude, longitude, radius, accept))
+
+    # The k nearest cars, optionally at most radius meters away. Looks at the
+    # rings of cells around the point until the k-th car found is nearer than
+    # any car in the next ring could be.
+    def nearest(self, latitude, longitude, k, accept=None, radius=math.inf):
+        with self.lock:
+            if self.kx is None or k <= 0:
+                return []
+            center = self.key(latitude, longitude)
+            found = []
+
+            ring = 0
+            while True:
+                cells = self.ring(center, ring)
+                if len(cells) > len(self.cells):
+                    # Sparse fleet far away: cheaper to look at every cell left
+                    cells = [key for key in self.cells
+                             if max(abs(key[0] - center[0]), abs(key[1] - center[1])) >= ring]
+                    found.extend(self.scan(cells, latitude, longitude, radius, accept))
+                    break
+
+                found.extend(self.scan(cells, latitude, longitude, radius, accept))
+                # Any car in the next rings is at least ring cells away
+                reach = ring * self.cell
+                if reach >= radius:
+                    break
+                if len(found) >= k and heapq.nsmallest(k, found)[-1][0] <= reach:
+                    break
+                ring += 1
+
+            return heapq.nsmallest(k, found)
+
+# ------------------------------------------------------------------------------ #
+
+# Answer to a PTIN2023/CAR/NEAREST request (see commands.py): the k nearest cars
+# to the point, or every car within radius meters when k is not given, only
+# the ones in status_car "state" if it is given. cars is {id_car: vcar}.
+def nearest_cars(positions, cars, status_names, payload):
+    latitude, longitude = payload["latitude"], payload["longitude"]
+    state = payload.get("state")
+    if state is not None and state not in status_names.values():
+        raise ValueError("unknown state " + state)
+
+    accept = None
+    if state is not None:
+        def accept(id):
+            car = cars.get(id)
+            return car is not None and status_names[car.status] == state
+
+    radius = payload.get("radius")
+    if payload.get("k") is None and radius is None:
+        raise ValueError("k or radius needed")
+    if payload.get("k") is not None:
+        found = positions.nearest(latitude, longitude, payload["k"], accept, math.inf if radius is None else radius)
+    else:
+        found = positions.within(latitude, longitude, radius, accept)
+
+    return {"result": "ok",
+            "cars": [{"id_car": id,
+                      "latitude": lat,
+                      "longitude": lon,
+                      "distance": round(distance, 1),
+                      "status": status_names[cars[id].status] if id in cars else None}
+                     for distance, id, lat, lon in found]}
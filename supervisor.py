@@ -0,0 +1,184 @@
+import os
+import time
+import queue
+import multiprocessing
+from threading import Thread
+from collections import Counter
+# ------------------------------------------------------------------------------ #
+# Splits the car ids 1..NUM_CARS across WORKERS processes (one per core by
+# default), each one a full simulator with its own MQTT connections, so the
+# fleet is no longer capped by a single GIL. The supervisor collects a health
+# report from every worker and restarts the ones that die, stop reporting or
+# stop making progress: cars on the road whose tick counter does not move.
+# Restarts of the same worker back off exponentially, from RESTART_DELAY up
+# to RESTART_MAX_DELAY seconds, until it runs that long without failing.
+#
+#   NUM_CARS=5000 CAR_SPEED=0.0005 ENGINE=asyncio python3 supervisor.py
+# ------------------------------------------------------------------------------ #
+
+num_cars = int(os.environ.get('NUM_CARS'))
+workers = int(os.environ.get('WORKERS', os.cpu_count() or 1))
+health_interval = float(os.environ.get('HEALTH_INTERVAL', 5))
+restart_delay = float(os.environ.get('RESTART_DELAY', 1))
+restart_max_delay = float(os.environ.get('RESTART_MAX_DELAY', 60))
+
+# status_car states of the cars that tick while the simulation runs
+moving = ("delivering", "returning")
+
+# Car ids of every worker, as (first_car, num_cars)
+def shards(total, parts):
+    parts = max(1, min(parts, total))
+    size, extra = divmod(total, parts)
+    first = 1
+    for i in range(parts):
+        count = size + (1 if i < extra else 0)
+        yield first, count
+        first += count
+
+def worker(index, first, count, health):
+    os.environ['FIRST_CAR'] = str(first)
+    os.environ['NUM_CARS'] = str(count)
+
+    # Every worker serves its metrics on its own port
+    if os.environ.get('METRICS_PORT'):
+        os.environ['METRICS_PORT'] = str(int(os.environ['METRICS_PORT']) + index)
+
+    # and restores its own cars from its own checkpoint
+    if os.environ.get('CHECKPOINT_FILE'):
+        os.environ['CHECKPOINT_FILE'] = "%s.%d" % (os.environ['CHECKPOINT_FILE'], index)
+
+    import virtualCar_anomaly as sim
+    import metrics
+
+    # The report thread keeps going even if the simulation is stuck, the tick
+    # counter is what tells the supervisor it still moves
+    def report(cars):
+        def loop():
+            while True:
+                states = Counter(sim.status_car[car.status] for car in cars)
+                health.put((index, os.getpid(), time.time(), len(cars), dict(states), metrics.ticks.snapshot()))
+                time.sleep(health_interval)
+
+        Thread(target=loop, daemon=True).start()
+
+    sim.main(report)
+
+# ------------------------------------------------------------------------------ #
+
+class supervisor:
+    def __init__(self, total, parts) -> None:
+        self.context = multiprocessing.get_context("spawn")
+        self.health = self.context.Queue()
+
+        self.shards = list(shards(total, parts))
+        self.processes = [None] * len(self.shards)
+        self.reports = [None] * len(self.shards)
+        self.restarts = [0] * len(self.shards)
+
+        # Per worker: when it started, last time its ticks moved (or no car
+        # had to move), failures in a row and when it is due to restart
+        self.started = [None] * len(self.shards)
+        self.progress = [None] * len(self.shards)
+        self.failures = [0] * len(self.shards)
+        self.restart_at = [None] * len(self.shards)
+
+    def start_worker(self, index):
+        first, count = self.shards[index]
+        process = self.context.Process(target=worker, args=(index, first, count, self.health), daemon=True)
+        process.start()
+
+        self.processes[index] = process
+        self.reports[index] = None
+        self.started[index] = self.progress[index] = time.time()
+        self.restart_at[index] = None
+        print("SUPERVISOR | Worker %d (pid %d): cotxes %d-%d" % (index, process.pid, first, first + count - 1))
+
+    def received(self, report):
+        index, pid, at = report[:3]
+        # Ignore late reports from a worker that was already replaced
+        if pid != self.processes[index].pid:
+            return
+
+        last = self.reports[index]
+        states = report[4]
+        if last is None or report[5] != last[5] or not any(states.get(state) for state in moving):
+            self.progress[index] = at
+        self.reports[index] = report
+
+        # Running long enough since its last restart, the back-off starts over
+        if at - self.started[index] >= restart_max_delay:
+            self.failures[index] = 0
+
+    # Why the worker has to be restarted, None if it is fine
+    def failure(self, index, now):
+        process = self.processes[index]
+        report = self.reports[index]
+        timeout = 3 * health_interval
+
+        if not process.is_alive():
+            return "mort (codi %s)" % process.exitcode
+        if now - (report[2] if report is not None else self.started[index]) > timeout:
+            return "no respon"
+        if now - self.progress[index] > timeout:
+            return "encallat, %d ticks" % report[5]
+        return None
+
+    def check(self):
+        now = time.time()
+        for index, process in enumerate(self.processes):
+            if self.restart_at[index] is not None:
+                if now >= self.restart_at[index]:
+                    self.restarts[index] += 1
+                    self.start_worker(index)
+                continue
+
+            reason = self.failure(index, now)
+            if reason is None:
+                continue
+
+            if process.is_alive():
+                process.kill()
+                process.join()
+
+            delay = min(restart_delay * 2 ** self.failures[index], restart_max_delay)
+            self.failures[index] += 1
+            self.restart_at[index] = now + delay
+            print("SUPERVISOR | Worker %d %s, reiniciant en %.0f s..." % (index, reason, delay))
+
+    def summary(self):
+        alive = sum(1 for process in self.processes if process.is_alive())
+        cars = 0
+        states = Counter()
+        for report in self.reports:
+            if report is not None:
+                cars += report[3]
+                states.update(report[4])
+
+        line = "SUPERVISOR | Workers: %d/%d | Cotxes: %d | Reinicis: %d" % (alive, len(self.processes), cars, sum(self.restarts))
+        for state, total in sorted(states.items()):
+            line += " | %s: %d" % (state, total)
+        print(line)
+
+    def run(self):
+        for index in range(len(self.shards)):
+            self.start_worker(index)
+
+        last_summary = time.time()
+        while True:
+            # Drain the health reports for at most one second
+            deadline = time.time() + 1
+            while True:
+                try:
+                    report = self.health.get(timeout=max(deadline - time.time(), 0))
+                except queue.Empty:
+                    break
+                self.received(report)
+
+            self.check()
+
+            if time.time() - last_summary >= health_interval:
+                self.summary()
+                last_summary = time.time()
+
+if __name__ == '__main__':
+    supervisor(num_cars, workers).run()
@@ -0,0 +1,34 @@
+import os
+import sys
+
+# The simulator reads its configuration when imported
+os.environ.setdefault('NUM_CARS', '2')
+os.environ.setdefault('CAR_SPEED', '0.0003')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# ------------------------------------------------------------------------------ #
+# Helpers of the simulation tests
+
+route = '[[2.176148,41.421548],[2.16762,41.412775],[2.166726,41.412418],[2.167433,41.411434],[2.178958,41.397453]]'
+
+class recording_publisher:
+    def __init__(self, clock) -> None:
+        self.clock = clock
+        self.locations = []
+        self.statuses = []
+
+    def publish_location(self, msg):
+        self.locations.append((self.clock.now(), msg))
+
+    def publish_status(self, msg):
+        self.statuses.append((self.clock.now(), msg))
+
+    def publish(self, *args, **kwargs):
+        pass
+
+def startroute(car, at):
+    yield at
+    car.on_startroute({"id_car": car.ID, "order": 1, "route": route})
+
+def delivered_at(publisher, id):
+    return next(at for at, msg in publisher.statuses if msg["id_car"] == id and msg["status"] == "unloading_c")
@@ -0,0 +1,53 @@
+import json
+import pytest
+import virtualCar_anomaly as sim
+from engine import virtual_clock
+from mqtt_fleet import publisher
+from conftest import startroute
+
+class batch_publisher(publisher):
+    def __init__(self, clock) -> None:
+        super().__init__(None, None)
+        self.clock = clock
+        self.batches = []
+        self.enable_batching(batch_size=500, flush_interval=sim.delta_time, per_car=False)
+
+    def send(self, topic, payload, qos=0):
+        if topic == self.batch_topic:
+            self.batches.append((self.clock.now(), [msg["id_car"] for msg in json.loads(payload)]))
+
+def run(numpy):
+    clock = virtual_clock()
+    client = batch_publisher(clock)
+    stepper = None
+    if numpy:
+        pytest.importorskip("numpy")
+        from fleet_stepper import fleet_stepper
+        stepper = fleet_stepper(sim.car_speed, sim.delta_time, client)
+    cars = [sim.vcar(i, client, stepper) for i in (1, 2)]
+
+    for car in cars:
+        clock.spawn(car.lifecycle())
+    clock.spawn(stepper.ticks(clock) if numpy else client.batching())
+    clock.spawn(startroute(cars[0], 0))
+    clock.spawn(startroute(cars[1], 20))
+
+    # Runs until the whole fleet waits for a new route
+    clock.run(wait_external=False)
+    return client
+
+@pytest.mark.parametrize("numpy", [False, True])
+def test_one_location_per_car_and_tick(numpy):
+    client = run(numpy)
+
+    assert client.batches
+    assert all(len(ids) == len(set(ids)) for at, ids in client.batches)
+    # The last locations are not left behind when the fleet goes idle
+    assert client.batch == []
+
+def test_numpy_stepper_sends_one_batch_per_tick():
+    client = run(numpy=True)
+
+    # Both cars are on the road once the second one is loaded at t=30
+    both = [ids for at, ids in client.batches if 31 < at < 60]
+    assert both and all(sorted(ids) == [1, 2] for ids in both)
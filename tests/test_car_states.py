@@ -0,0 +1,25 @@
+import virtualCar_anomaly as sim
+from engine import virtual_clock
+from conftest import recording_publisher, startroute
+
+def run_with_anomaly(anomaly, at, until=1000):
+    clock = virtual_clock()
+    publisher = recording_publisher(clock)
+    car = sim.vcar(1, publisher)
+
+    clock.spawn(car.lifecycle())
+    clock.spawn(startroute(car, 0))
+    clock.call_later(at, lambda: car.on_anomalia({"id_car": 1, "hehe": anomaly}))
+    clock.run(until, wait_external=False)
+    return [msg["status"] for at, msg in publisher.statuses]
+
+def test_battery_alert_published_once():
+    # Second half of the way to the hive: the car goes on and reports there
+    statuses = run_with_anomaly("set_battery_10", 60)
+    assert statuses.count("alert") == 1
+    assert statuses[-1] == "waits"
+
+def test_alert_after_turning_around():
+    statuses = run_with_anomaly("set_battery_10", 12)
+    assert statuses.count("alert") == 1
+    assert "unloading_c" not in statuses
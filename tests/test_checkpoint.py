@@ -0,0 +1,78 @@
+import threading
+import pytest
+import checkpoint
+import virtualCar_anomaly as sim
+from engine import virtual_clock
+from conftest import recording_publisher, startroute, delivered_at, route
+
+def fleet(clock, numpy):
+    publisher = recording_publisher(clock)
+    stepper = None
+    if numpy:
+        pytest.importorskip("numpy")
+        from fleet_stepper import fleet_stepper
+        stepper = fleet_stepper(sim.car_speed, sim.delta_time)
+    cars = [sim.vcar(i, publisher, stepper) for i in (1, 2)]
+    return publisher, stepper, cars
+
+def start(clock, stepper, cars):
+    for car in cars:
+        clock.spawn(car.lifecycle())
+    if stepper is not None:
+        clock.spawn(stepper.ticks(clock))
+
+def check_restore(tmp_path, numpy, at=40):
+    path = str(tmp_path / "fleet.vck")
+
+    # Uninterrupted run
+    clock = virtual_clock()
+    publisher, stepper, cars = fleet(clock, numpy)
+    start(clock, stepper, cars)
+    clock.spawn(startroute(cars[0], 0))
+    clock.spawn(startroute(cars[1], 20))
+    clock.run(at, wait_external=False)
+    checkpoint.write(path, cars, clock.now())
+    clock.run(400, wait_external=False)
+
+    # Restarted from the snapshot, in the middle of both deliveries
+    restarted = virtual_clock()
+    restored, stepper, cars = fleet(restarted, numpy)
+    assert checkpoint.restore(path, cars) == 2
+    assert all(car.distance > 0 for car in cars)
+    start(restarted, stepper, cars)
+    restarted.run(400 - at, wait_external=False)
+
+    for id in (1, 2):
+        assert abs(at + delivered_at(restored, id) - delivered_at(publisher, id)) < 1.0
+
+def test_restore_scalar(tmp_path):
+    check_restore(tmp_path, numpy=False)
+
+def test_restore_numpy(tmp_path):
+    check_restore(tmp_path, numpy=True)
+
+def test_snapshot_waits_for_the_step_in_progress(tmp_path):
+    path = str(tmp_path / "fleet.vck")
+    clock = virtual_clock()
+    publisher, stepper, cars = fleet(clock, numpy=False)
+    car = cars[0]
+    car.route = sim.routes.get(route)
+
+    # End of the delivery: car_return flipped, the distance not reset and the
+    # step not changed yet
+    with car.lock:
+        car.state = "delivering"
+        car.distance = car.route.length
+        car.car_return = True
+        writer = threading.Thread(target=checkpoint.write, args=(path, cars, 0.0))
+        writer.start()
+        writer.join(0.1)
+        assert writer.is_alive()
+
+        car.distance = 0
+        car.state = "unloading_c"
+    writer.join()
+
+    restored = fleet(clock, numpy=False)[2]
+    checkpoint.restore(path, restored)
+    assert (restored[0].state, restored[0].car_return, restored[0].distance) == ("unloading_c", True, 0)
@@ -0,0 +1,35 @@
+import json
+
+import pytest
+
+import commands
+
+topic = "PTIN2023/CAR/NEAREST"
+
+@pytest.fixture(autouse=True)
+def stdlib_json(monkeypatch):
+    # The stdlib decoder (Alpine image, no orjson) accepts Infinity and 1e400
+    monkeypatch.setattr(commands, "loads", json.loads)
+
+def parse(text):
+    return commands.parse(topic, text.encode("utf-8"))
+
+def test_nearest_accepted():
+    payload = parse('{"latitude": 41.4, "longitude": 2.17, "k": 2, "radius": 500}')
+    assert payload["k"] == 2
+
+@pytest.mark.parametrize("text", [
+    '{"latitude": 1e308, "longitude": 2.17, "k": 2}',
+    '{"latitude": 1e400, "longitude": 2.17, "k": 2}',
+    '{"latitude": -90.5, "longitude": 2.17, "k": 2}',
+    '{"latitude": NaN, "longitude": 2.17, "k": 2}',
+    '{"latitude": 41.4, "longitude": 180.1, "k": 2}',
+    '{"latitude": 41.4, "longitude": -Infinity, "k": 2}',
+    '{"latitude": 41.4, "longitude": 2.17, "radius": Infinity}',
+    '{"latitude": 41.4, "longitude": 2.17, "radius": -1}',
+    '{"latitude": 41.4, "longitude": 2.17, "k": 0}',
+    '{"latitude": 41.4, "longitude": 2.17, "k": -3}',
+])
+def test_nearest_out_of_range_rejected(text):
+    with pytest.raises(commands.command_error):
+        parse(text)
@@ -0,0 +1,74 @@
+import wire_format
+from engine import virtual_clock
+from mqtt_fleet import publisher
+
+class capturing_publisher(publisher):
+    def __init__(self) -> None:
+        super().__init__(None, None)
+        self.sent = []
+
+    def send(self, topic, payload, qos=0):
+        self.sent.append((topic.rsplit("/", 1)[-1], wire_format.loads(payload)))
+        return super().send(topic, payload, qos)
+
+def deadband():
+    clock = virtual_clock()
+    client = capturing_publisher()
+    client.enable_deadband(clock, min_distance=25.0, battery_delta=1.0, heartbeat=5.0)
+    return clock, client
+
+# north is in meters from the first location
+def location(north=0.0, battery=90.0, status_num=3):
+    return {"id_car": 1, "location_act": {"latitude": 41.4 + north / 110540, "longitude": 2.17},
+            "status_num": status_num, "status": "delivering", "battery": battery, "autonomy": 1500.0}
+
+def sent_locations(client):
+    return [msg["location_act"]["latitude"] for topic, msg in client.sent if topic == "UPDATELOCATION"]
+
+def test_small_moves_are_held_back():
+    clock, client = deadband()
+    client.publish_location(location(0))
+    client.publish_location(location(10))
+    client.publish_location(location(24))
+    assert len(client.sent) == 1
+
+    # 30 meters away from the last one published, not from the last one held
+    client.publish_location(location(30))
+    assert sent_locations(client) == [location(0)["location_act"]["latitude"], location(30)["location_act"]["latitude"]]
+
+def test_battery_and_status_changes_are_sent():
+    clock, client = deadband()
+    client.publish_location(location(battery=90.0))
+    client.publish_location(location(battery=89.5))
+    assert len(client.sent) == 1
+
+    client.publish_location(location(battery=89.0))
+    assert len(client.sent) == 2
+
+    client.publish_location(location(battery=89.0, status_num=4))
+    assert len(client.sent) == 3
+
+def test_heartbeat():
+    clock, client = deadband()
+    client.publish_location(location())
+    clock.time = 4.9
+    client.publish_location(location())
+    assert len(client.sent) == 1
+
+    clock.time = 5.0
+    client.publish_location(location())
+    assert len(client.sent) == 2
+
+def test_held_location_flushed_before_the_next_status():
+    clock, client = deadband()
+    client.publish_location(location(0))
+    client.publish_location(location(10))
+    client.publish_status({"id_car": 1, "status_num": 2, "status": "unloading_c"})
+
+    # The cloud sees where the ride ended, then the new status
+    assert [topic for topic, msg in client.sent] == ["UPDATELOCATION", "UPDATELOCATION", "UPDATESTATUS"]
+    assert sent_locations(client)[-1] == location(10)["location_act"]["latitude"]
+
+    # Nothing left held back for the next one
+    client.publish_status({"id_car": 1, "status_num": 4, "status": "returning"})
+    assert [topic for topic, msg in client.sent][-2:] == ["UPDATESTATUS", "UPDATESTATUS"]
@@ -0,0 +1,26 @@
+import json
+
+import pytest
+
+import metrics
+from routes import pack_points
+from mqtt_fleet import dispatcher
+
+class failing_car:
+    ID = 1
+
+    def on_startroute(self, payload):
+        raise OverflowError("int too large to convert to float")
+
+def test_huge_coordinate_is_a_value_error():
+    with pytest.raises(ValueError):
+        pack_points([[10**400, 41.4], [2.17, 41.4]])
+
+def test_handler_exception_does_not_reach_paho():
+    clientR = dispatcher(None, None)
+    clientR.register(failing_car())
+    before = metrics.command_errors.snapshot().get("PTIN2023/CAR/STARTROUTE", 0)
+
+    clientR.dispatch("PTIN2023/CAR/STARTROUTE", json.dumps({"id_car": 1, "order": 1, "route": "[[2.17, 41.4]]"}).encode("utf-8"))
+
+    assert metrics.command_errors.snapshot()["PTIN2023/CAR/STARTROUTE"] == before + 1
@@ -0,0 +1,66 @@
+import threading
+from engine import virtual_clock, waiter, locked
+
+def periodic(clock, interval, times):
+    while True:
+        yield interval
+        times.append(clock.now())
+
+def test_daemons_only_run_alongside_other_processes():
+    clock = virtual_clock()
+    times = []
+
+    def ride():
+        yield 25
+
+    clock.spawn(periodic(clock, 10, times), daemon=True)
+    clock.spawn(ride())
+    clock.run(wait_external=False)
+
+    # Nothing but the daemon is left after the ride ends at t=25
+    assert times == [10, 20]
+    assert clock.now() == 25
+
+def test_daemons_park_until_another_thread_schedules_work():
+    clock = virtual_clock()
+    times = []
+    command = waiter()
+
+    def car():
+        yield command
+        yield 15
+
+    clock.spawn(periodic(clock, 10, times), daemon=True)
+    clock.spawn(car())
+    clock.run(wait_external=False)
+    assert times == []
+
+    command.set()
+    clock.run(wait_external=False)
+    assert times == [10]
+    assert clock.now() == 15
+
+def test_until_still_runs_the_daemons():
+    clock = virtual_clock()
+    times = []
+
+    clock.spawn(periodic(clock, 10, times), daemon=True)
+    clock.run(35, wait_external=False)
+
+    assert times == [10, 20, 30]
+
+def test_locked_process_releases_the_lock_while_it_waits():
+    lock = threading.Lock()
+    held = []
+
+    def process():
+        held.append(lock.locked())
+        yield 1
+        held.append(lock.locked())
+
+    steps = locked(process(), lock)
+    assert next(steps) == 1
+    assert not lock.locked()
+    assert list(steps) == []
+    assert held == [True, True]
+    assert not lock.locked()
@@ -0,0 +1,11 @@
+import os
+import sys
+import subprocess
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def test_records_written_at_exit():
+    script = "import fleet_log; fleet_log.setup(); fleet_log.car_log.error('abans de sortir'); raise SystemExit(3)"
+    result = subprocess.run([sys.executable, "-c", script], cwd=root, capture_output=True, text=True, timeout=30)
+    assert result.returncode == 3
+    assert "ERROR abans de sortir" in result.stdout
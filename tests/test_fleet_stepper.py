@@ -0,0 +1,88 @@
+import random
+from types import SimpleNamespace
+import pytest
+import virtualCar_anomaly as sim
+from engine import virtual_clock, waiter
+from routes import route_index
+from conftest import recording_publisher, startroute, delivered_at
+
+np = pytest.importorskip("numpy")
+from fleet_stepper import fleet_stepper
+
+# Car 1 starts at t=0 and car 2 at t=50, while car 1 is half way to the hive
+def run(numpy, until=400):
+    clock = virtual_clock()
+    publisher = recording_publisher(clock)
+    stepper = fleet_stepper(sim.car_speed, sim.delta_time) if numpy else None
+    cars = [sim.vcar(i, publisher, stepper) for i in (1, 2)]
+
+    for car in cars:
+        clock.spawn(car.lifecycle())
+    clock.spawn(startroute(cars[0], 0))
+    clock.spawn(startroute(cars[1], 50))
+    if stepper is not None:
+        clock.spawn(stepper.ticks(clock))
+    clock.run(until, wait_external=False)
+    return publisher
+
+def test_car_keeps_its_place_when_another_car_starts():
+    publisher = run(numpy=True)
+
+    # Car 1 only goes forward along the route while delivering
+    latitudes = [msg["location_act"]["latitude"] for at, msg in publisher.locations
+                 if msg["id_car"] == 1 and msg["status"] == "delivering"]
+    assert all(b <= a + 1e-12 for a, b in zip(latitudes, latitudes[1:]))
+
+def test_numpy_stepper_matches_scalar_rides():
+    scalar = run(numpy=False)
+    numpy = run(numpy=True)
+
+    for id in (1, 2):
+        assert abs(delivered_at(numpy, id) - delivered_at(scalar, id)) < 1.0
+
+def test_idle_stepper_parks_the_discrete_engine():
+    clock = virtual_clock()
+    stepper = fleet_stepper(sim.car_speed, sim.delta_time)
+    car = sim.vcar(1, recording_publisher(clock), stepper)
+
+    clock.spawn(car.lifecycle())
+    clock.spawn(stepper.ticks(clock))
+    clock.run(wait_external=False)
+    assert clock.now() == 0
+
+    # A route wakes the stepper up, the car drives there and back and the
+    # engine parks again while it waits for the next one
+    clock.spawn(startroute(car, 0))
+    clock.run(wait_external=False)
+    assert sim.status_car[car.status] == "waits"
+    assert not stepper.cars
+    assert clock.now() > 0
+
+def test_routes_keep_their_slot_while_cars_come_and_go():
+    rng = random.Random(7)
+    routes = [route_index([[2.17 + rng.random() / 100, 41.40 + rng.random() / 100] for _ in range(rng.randint(2, 30))])
+              for _ in range(12)]
+    stepper = fleet_stepper(sim.car_speed, sim.delta_time)
+
+    for _ in range(40):
+        joining = [SimpleNamespace(route=rng.choice(routes), battery_level=100.0, autonomy=100.0) for _ in range(rng.randint(0, 6))]
+        for car in joining:
+            car.distance = rng.random() * car.route.length
+        stepper.join([(car, waiter()) for car in joining])
+
+        keep = [rng.random() < 0.7 for _ in stepper.cars]
+        if stepper.cars:
+            kept = [car for car, k in zip(stepper.cars, keep) if k]
+            stepper.leave(np.array(keep))
+            assert stepper.cars == kept
+
+        # Every car still finds its own route in the packed arrays
+        latitude, longitude, _ = stepper.position(stepper.distance)
+        for k, car in enumerate(stepper.cars):
+            expected = car.route.position(car.distance)
+            assert abs(latitude[k] - expected[0]) < 1e-12
+            assert abs(longitude[k] - expected[1]) < 1e-12
+
+    # Freed routes are compacted, never more than half of the packed points
+    assert stepper.free_points * 2 <= stepper.used
+    assert len(stepper.slots) == len({id(car.route) for car in stepper.cars})
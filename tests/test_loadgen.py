@@ -0,0 +1,31 @@
+import json
+
+from loadgen import tracker, location_topic, batch_topic
+
+def location(id):
+    return {"id_car": id, "location_act": {"latitude": 41.4, "longitude": 2.17}, "status_num": 3, "battery": 99.0, "autonomy": 1999.0}
+
+def test_locations_counted_once_with_batching():
+    track = tracker(location_topic)
+    track.sent(1)
+    track.sent(2)
+
+    # Per-car telemetry and the fleet batch carry the same locations
+    for id in (1, 2):
+        track.received(location_topic, json.dumps(location(id)), "json")
+    track.received(batch_topic, json.dumps([location(1), location(2)]), "json")
+
+    results = track.report(1.0)
+    assert results["locations"] == 2
+    assert results["answered"] == 2
+    assert results["lost"] == 0
+
+def test_batch_only():
+    track = tracker(batch_topic)
+    track.sent(1)
+    track.sent(2)
+    track.received(batch_topic, json.dumps([location(1)]), "json")
+
+    results = track.report(1.0)
+    assert results["locations"] == 1
+    assert results["lost"] == 1
@@ -0,0 +1,41 @@
+from mqtt_fleet import outbound, publisher
+
+def drain(queue):
+    messages = []
+    while len(queue):
+        topic, payload, _ = queue.get()
+        messages.append(payload)
+    return messages
+
+def test_location_coalesced_in_place():
+    queue = outbound(10)
+    queue.put("LOC", "car1 a", key=1)
+    queue.put("LOC", "car2 a", key=2)
+    queue.put("LOC", "car1 b", key=1)
+    assert drain(queue) == ["car1 b", "car2 a"]
+
+def test_location_does_not_overtake_later_status():
+    queue = outbound(10)
+    queue.put("LOC", "car1 end of delivering", key=1)
+    queue.put("STATUS", "car1 unloading_c")
+    queue.put("LOC", "car1 returning", key=1)
+    assert drain(queue) == ["car1 unloading_c", "car1 returning"]
+
+def test_full_queue_drops_oldest_location():
+    queue = outbound(2)
+    queue.put("LOC", "car1", key=1)
+    queue.put("LOC", "car2", key=2)
+    queue.put("LOC", "car3", key=3)
+    assert drain(queue) == ["car2", "car3"]
+
+def test_stop_flushes_the_last_batch():
+    sent = []
+    client = publisher(None, None)
+    client.send = lambda topic, payload, qos=0: sent.append(topic)
+    client.enable_batching(batch_size=100, flush_interval=60, per_car=False)
+
+    client.publish_location({"id_car": 1, "location_act": {"latitude": 41.4, "longitude": 2.17},
+                             "status_num": 3, "battery": 99.0, "autonomy": 1999.0})
+    assert sent == []
+    client.stop()
+    assert sent == [client.batch_topic]
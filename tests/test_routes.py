@@ -0,0 +1,61 @@
+import math
+from array import array
+from routes import simplify, resample, meters_per_degree, route_cache
+
+latitude = 41.40
+
+# Route from a list of (east, north) offsets in meters
+def route(*offsets):
+    kx, ky = meters_per_degree([latitude])
+    return array('d', [value for east, north in offsets for value in (2.17 + east / kx, latitude + north / ky)])
+
+def pairs(points):
+    return list(zip(points[0::2], points[1::2]))
+
+# Meters between consecutive points, with the scale of the route they came from
+def spacing(points, original):
+    kx, ky = meters_per_degree(original[1::2].tolist())
+    return [math.hypot((lon2 - lon1) * kx, (lat2 - lat1) * ky)
+            for (lon1, lat1), (lon2, lat2) in zip(pairs(points), pairs(points)[1:])]
+
+def test_simplify_drops_collinear_points():
+    points = route(*[(10 * i, 0) for i in range(20)])
+    assert pairs(simplify(points, 1.0)) == [pairs(points)[0], pairs(points)[-1]]
+
+def test_simplify_keeps_points_beyond_tolerance():
+    points = route((0, 0), (100, 0), (200, 30), (300, 0), (400, 2), (500, 0))
+
+    kept = pairs(simplify(points, 10.0))
+    assert kept == [pairs(points)[i] for i in (0, 1, 2, 3, 5)]
+
+    # Above the largest deviation only the ends are left
+    assert pairs(simplify(points, 50.0)) == [pairs(points)[0], pairs(points)[-1]]
+
+def test_simplify_keeps_the_ends_of_a_loop():
+    points = route((0, 0), (100, 0), (100, 100), (0, 100), (0, 0))
+    kept = pairs(simplify(points, 10.0))
+    assert kept[0] == pairs(points)[0] and kept[-1] == pairs(points)[-1]
+    assert len(kept) == 5
+
+def test_resample_spacing_is_the_step():
+    points = route((0, 0), (120, 0), (120, 95), (400, 95))
+    resampled = resample(points, 25.0)
+
+    gaps = spacing(resampled, points)
+    # Straight stretches are exactly step apart, corners are cut
+    assert all(abs(gap - 25.0) < 1e-6 for gap in gaps[:4])
+    assert all(gap <= 25.0 + 1e-6 for gap in gaps)
+    assert pairs(resampled)[0] == pairs(points)[0]
+    assert pairs(resampled)[-1] == pairs(points)[-1]
+    assert len(gaps) == math.ceil((120 + 95 + 280) / 25.0)
+
+def test_zero_disables_both_stages():
+    points = route((0, 0), (10, 0), (20, 0), (30, 40))
+    assert simplify(points, 0) is points
+    assert resample(points, 0) is points
+
+    compiled = route_cache().get([list(pair) for pair in pairs(points)])
+    assert len(compiled) == compiled.received == compiled.simplified == 4
+
+    simplified_only = route_cache(tolerance=1.0).get([list(pair) for pair in pairs(points)])
+    assert (simplified_only.received, simplified_only.simplified, len(simplified_only)) == (4, 3, 3)
@@ -0,0 +1,89 @@
+import supervisor as sup
+
+class fake_process:
+    def __init__(self, pid) -> None:
+        self.pid = pid
+        self.alive = True
+        self.exitcode = None
+
+    def is_alive(self):
+        return self.alive
+
+    def kill(self):
+        self.alive = False
+
+    def join(self):
+        pass
+
+class fake_clock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+def supervised(monkeypatch):
+    clock = fake_clock()
+    monkeypatch.setattr(sup.time, "time", clock.time)
+    monkeypatch.setattr(sup, "health_interval", 5.0)
+    monkeypatch.setattr(sup, "restart_delay", 1.0)
+    monkeypatch.setattr(sup, "restart_max_delay", 60.0)
+
+    pids = iter(range(100, 200))
+    s = sup.supervisor(2, 1)
+    def start_worker(index):
+        s.processes[index] = fake_process(next(pids))
+        s.reports[index] = None
+        s.started[index] = s.progress[index] = clock.now
+        s.restart_at[index] = None
+    s.start_worker = start_worker
+    start_worker(0)
+    return s, clock
+
+def report(s, clock, ticks, states):
+    s.received((0, s.processes[0].pid, clock.now, 2, states, ticks))
+
+def test_stuck_worker_is_restarted(monkeypatch):
+    s, clock = supervised(monkeypatch)
+    process = s.processes[0]
+
+    # Still reporting, but the cars on the road do not tick any more
+    for _ in range(4):
+        report(s, clock, 500, {"delivering": 2})
+        clock.now += 5
+        s.check()
+    assert not process.is_alive()
+    assert s.restart_at[0] == clock.now + 1
+
+    clock.now += 1
+    s.check()
+    assert s.processes[0] is not process
+    assert s.restarts == [1]
+
+def test_idle_fleet_is_not_stuck(monkeypatch):
+    s, clock = supervised(monkeypatch)
+    for _ in range(10):
+        report(s, clock, 500, {"waits": 2})
+        clock.now += 5
+        s.check()
+    assert s.processes[0].is_alive()
+    assert s.restart_at[0] is None
+
+def test_restarts_back_off(monkeypatch):
+    s, clock = supervised(monkeypatch)
+
+    delays = []
+    for _ in range(8):
+        s.processes[0].alive = False
+        s.check()
+        delays.append(s.restart_at[0] - clock.now)
+        clock.now = s.restart_at[0]
+        s.check()
+    assert delays == [1, 2, 4, 8, 16, 32, 60, 60]
+
+    # A worker that runs long enough starts over
+    clock.now += 60
+    report(s, clock, 1, {"delivering": 2})
+    s.processes[0].alive = False
+    s.check()
+    assert s.restart_at[0] - clock.now == 1
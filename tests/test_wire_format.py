@@ -0,0 +1,58 @@
+import struct
+import pytest
+import wire_format
+
+def location(id, latitude=41.412775, longitude=2.16762, status_num=3, battery=87.5, autonomy=1543.25):
+    return {"id_car": id, "location_act": {"latitude": latitude, "longitude": longitude},
+            "status_num": status_num, "status": "delivering", "battery": battery, "autonomy": autonomy}
+
+# Fields that go on the wire, the status string is dropped
+def sent(msg):
+    return {key: value for key, value in msg.items() if key != "status"}
+
+def test_struct_record_sizes():
+    assert wire_format.location_record.size == 29
+    assert wire_format.status_record.size == 5
+    assert len(wire_format.encode_location(location(1), "struct")) == 29
+    assert len(wire_format.encode_status({"id_car": 1, "status_num": 3}, "struct")) == 5
+
+def test_struct_field_order():
+    payload = wire_format.encode_location(location(7, battery=50.0, autonomy=25.0), "struct")
+    assert struct.unpack("<I", payload[0:4]) == (7,)
+    assert struct.unpack("<dd", payload[4:20]) == (41.412775, 2.16762)
+    assert payload[20] == 3
+    assert struct.unpack("<ff", payload[21:29]) == (50.0, 25.0)
+
+    assert wire_format.encode_status({"id_car": 7, "status_num": 4}, "struct") == struct.pack("<IB", 7, 4)
+
+@pytest.mark.parametrize("fmt", ["json", "struct", "msgpack"])
+def test_location_round_trip(fmt):
+    if fmt == "msgpack":
+        pytest.importorskip("msgpack")
+
+    # Battery and autonomy are f32 in struct, exact for these values
+    msg = location(3)
+    decoded = wire_format.decode_location(wire_format.encode_location(msg, fmt), fmt)
+    assert decoded == (msg if fmt == "json" else sent(msg))
+
+    status = {"id_car": 3, "status_num": 5}
+    assert wire_format.decode_status(wire_format.encode_status(status, fmt), fmt) == status
+
+@pytest.mark.parametrize("fmt", ["json", "struct", "msgpack"])
+def test_batch_round_trip(fmt):
+    if fmt == "msgpack":
+        pytest.importorskip("msgpack")
+
+    msgs = [location(id, latitude=41.4 + id / 1000, status_num=3 + id % 2) for id in range(1, 6)]
+    payload = wire_format.encode_locations(msgs, fmt)
+    if fmt == "struct":
+        # Just the records one after the other
+        assert len(payload) == 5 * wire_format.location_record.size
+        assert [fields[0] for fields in wire_format.location_record.iter_unpack(payload)] == [1, 2, 3, 4, 5]
+
+    decoded = wire_format.decode_locations(payload, fmt)
+    assert decoded == (msgs if fmt == "json" else [sent(msg) for msg in msgs])
+
+def test_unknown_format():
+    with pytest.raises(ValueError):
+        wire_format.check_format("xml")
@@ -1,9 +1,23 @@
-import math, time, argparse
-from threading import Thread
+import math
+import asyncio
+import atexit
+import logging
+from threading import Thread, Lock
 import os
 # ---------------------------- #
 import json
-import paho.mqtt.client as mqtt
+from mqtt_fleet import publisher, dispatcher
+from engine import waiter, locked, clock, virtual_clock, run_thread, run_async
+from routes import route_cache
+from spatial import grid, nearest_cars
+from fleet_table import fleet_table
+from car_states import steps, anomalies, ROUTE, RIDE
+from scenarios import scenario
+import checkpoint
+from recorder import recorder
+import fleet_log
+import metrics
+from fleet_log import car_log, tick_log
 # ------------------------------------------------------------------------------ #
 
 status_car = {
@@ -28,12 +42,101 @@ status_desc = {
     8 : "unloading_a - es troba en el magatzem descarregant."
 }
 
-mqtt_address = os.environ.get('MQTT_ADDRESS')
-mqtt_port = int(os.environ.get('MQTT_PORT'))
+mqtt_address = os.environ.get('MQTT_ADDRESS', 'localhost')
+mqtt_port = int(os.environ.get('MQTT_PORT', 1883))
 num_cars = int(os.environ.get('NUM_CARS'))
+
+# Id of the first car, the fleet is FIRST_CAR .. FIRST_CAR+NUM_CARS-1
+first_car = int(os.environ.get('FIRST_CAR', 1))
 car_speed = float(os.environ.get('CAR_SPEED'))
 delta_time = 0.33
 
+# "threads": one OS thread per car, "asyncio": the whole fleet on one event loop,
+# "discrete": discrete event simulation on virtual time, as fast as possible
+engine = os.environ.get('ENGINE', 'threads')
+
+# Simulated seconds per real second for the threads and asyncio engines
+time_scale = float(os.environ.get('TIME_SCALE', 1))
+
+# Simulated seconds to run with the discrete engine. If not set it runs until
+# stopped, waiting for commands from the cloud while the whole fleet is idle
+sim_duration = os.environ.get('SIM_DURATION')
+
+# "scalar": every car moves itself, "numpy": one vectorized step for the whole fleet
+stepper_kind = os.environ.get('STEPPER', 'scalar')
+
+# Batched fleet telemetry on PTIN2023/CAR/FLEETLOCATION, one array for all the cars
+batch_telemetry = os.environ.get('BATCH_TELEMETRY', '0') == '1'
+batch_size = int(os.environ.get('BATCH_SIZE', 500))
+# Simulated seconds between flushes when the cars move themselves, the numpy
+# stepper flushes once per tick
+batch_interval = float(os.environ.get('BATCH_INTERVAL', delta_time))
+per_car_telemetry = os.environ.get('PER_CAR_TELEMETRY', '1') == '1'
+
+# Dead-band telemetry: skip UPDATELOCATION unless the car moved TELEMETRY_MIN_DISTANCE
+# meters, the battery changed TELEMETRY_BATTERY_DELTA, the status changed or
+# TELEMETRY_HEARTBEAT seconds passed (see publisher.enable_deadband)
+telemetry_deadband = os.environ.get('TELEMETRY_DEADBAND', '0') == '1'
+telemetry_min_distance = float(os.environ.get('TELEMETRY_MIN_DISTANCE', 25))
+telemetry_battery_delta = float(os.environ.get('TELEMETRY_BATTERY_DELTA', 1))
+telemetry_heartbeat = float(os.environ.get('TELEMETRY_HEARTBEAT', 5))
+
+# Listen to PTIN2023/CAR/ANOMALIA, virtualCar.py runs the fleet without it
+forced_anomalies = os.environ.get('FORCED_ANOMALIES', '1') == '1'
+
+# Fleet-wide anomaly injection (see scenarios.py), SCENARIO_SEED overrides the
+# seed of the file
+scenario_file = os.environ.get('SCENARIO_FILE')
+scenario_seed = os.environ.get('SCENARIO_SEED')
+
+# Snapshot of the fleet every CHECKPOINT_INTERVAL seconds, restored on startup
+# if the file exists (see checkpoint.py)
+checkpoint_file = os.environ.get('CHECKPOINT_FILE')
+checkpoint_interval = float(os.environ.get('CHECKPOINT_INTERVAL', 5))
+
+# Bounded outbound queue drained by its own thread (see publisher.enable_queue),
+# PUBLISH_QUEUE_SIZE=0 publishes from the car threads as before
+publish_queue_size = int(os.environ.get('PUBLISH_QUEUE_SIZE', 10000))
+publish_max_inflight = int(os.environ.get('PUBLISH_MAX_INFLIGHT', 100))
+
+# Encoding of the telemetry: "json", "struct" or "msgpack" (see wire_format.py)
+wire = os.environ.get('WIRE_FORMAT', 'json')
+
+# JSONL capture of every command received and message published (see replay.py)
+record_file = os.environ.get('RECORD_FILE')
+
+# Logging (see fleet_log.py): per-tick lines are off by default and replaced by
+# a fleet summary every LOG_SUMMARY_INTERVAL seconds
+log_level = os.environ.get('LOG_LEVEL', 'INFO')
+log_format = os.environ.get('LOG_FORMAT', 'text')
+log_ticks = os.environ.get('LOG_TICKS', '0') == '1'
+tick_log_interval = float(os.environ.get('TICK_LOG_INTERVAL', 1))
+log_summary_interval = float(os.environ.get('LOG_SUMMARY_INTERVAL', 10))
+
+# Health metrics (see metrics.py): Prometheus text on http://localhost:METRICS_PORT/metrics
+# and/or JSON on METRICS_TOPIC every METRICS_INTERVAL seconds, both off if not set
+metrics_port = os.environ.get('METRICS_PORT')
+metrics_interval = float(os.environ.get('METRICS_INTERVAL', 0))
+metrics_topic = os.environ.get('METRICS_TOPIC', 'PTIN2023/CAR/STATS')
+
+# Compiled routes shared by the cars that receive the same route (see routes.py).
+# Received routes are simplified dropping the points closer than
+# ROUTE_SIMPLIFY_TOLERANCE meters to the rest of the route, and resampled to one
+# point every ROUTE_RESAMPLE_STEP meters, both off when 0
+route_cache_size = int(os.environ.get('ROUTE_CACHE_SIZE', 256))
+route_simplify_tolerance = float(os.environ.get('ROUTE_SIMPLIFY_TOLERANCE', 0))
+route_resample_step = float(os.environ.get('ROUTE_RESAMPLE_STEP', 0))
+routes = route_cache(route_cache_size, route_simplify_tolerance, route_resample_step)
+
+# Last position of every car in cells of SPATIAL_CELL meters (see spatial.py),
+# answers the nearest cars requests on PTIN2023/CAR/NEAREST, off when 0
+spatial_cell = float(os.environ.get('SPATIAL_CELL', 0))
+positions = grid(spatial_cell) if spatial_cell > 0 else None
+
+# Table with the state of every car (see fleet_table.py), served on
+# PTIN2023/CAR/FLEETSTATUS and on /fleet of the metrics server when FLEET_STATUS=1
+fleet_status = fleet_table(status_car) if os.environ.get('FLEET_STATUS', '0') == '1' else None
+
 # ------------------------------------------------------------------------------ #
 
 def get_angle(x1, y1, x2, y2):
@@ -41,30 +144,48 @@ def get_angle(x1, y1, x2, y2):
     dy = y2 - y1
     return math.atan2(dy, dx)
 
-def is_json(data):
-    try:
-        json.loads(data)
-        return True
-    except json.decoder.JSONDecodeError:
-        return False
 # ------------------------------------------------------------------------------ #
 
 class vcar:
-    def __init__(self, id) -> None:
-        self.clientS = mqtt.Client()
+    def __init__(self, id, publisher, stepper=None) -> None:
+        # Shared MQTT connection used for every outgoing message
+        self.publisher = publisher
+
+        # Optional fleet stepper that moves all the cars in one batch per tick
+        self.stepper = stepper
 
         self.ID = id
 
+        # Held by the lifecycle between two yields, by the fleet stepper while
+        # it moves the car and by the commands, so a checkpoint taken from
+        # another thread never sees half a step
+        self.lock = Lock()
+
         # Variables globals per forçar anomalies
         self.anomalia_forcada = False
         self.anomalia = ""
 
-        # State variables
+        # State variables, state is the current step of car_states.steps
+        self.state = "waits"
+        self.status = 5
         self.car_return = False
-        self.coordinates = None
-        self.start_coordinates = False
         self.interpolation_val = 0
 
+        # Set when an anomaly stopped the last ride before the end of the route
+        self.ride_stopped = False
+
+        # Set by checkpoint.restore: carry on with the current step where the
+        # snapshot left it instead of entering it again
+        self.resume = False
+
+        # Shared route being driven (see routes.py), None while the car is idle,
+        # and distance travelled along it
+        self.route = None
+        self.distance = 0
+
+        # Released by on_startroute when a route arrives for an idle car
+        self.route_ready = waiter()
+
         # Initialize the battery level and the autonomy
         self.autonomy = 2000
         self.battery_level = 100
@@ -84,98 +205,79 @@ class vcar:
         # Update the autonomy based on the distance traveled and the battery usage
         self.autonomy -= distance_traveled / 100 * self.battery_level * 20
 
-        stats = "CAR: %d | Battery level: %.2f | Autonomy: %.2f | Coord: %s | " % (self.ID, self.battery_level, self.autonomy, str(self.interpolation_to_coord()))
+        # Per-tick line, off by default (LOG_TICKS=1) and rate limited per car
+        if not tick_log.isEnabledFor(logging.DEBUG):
+            return self.battery_level, self.autonomy
 
         # Send signal to the car to move in the appropriate direction based on the angle
         if angle > math.pi/4 and angle < 3*math.pi/4:
             # Move forward
-            print(stats + "Moving forward")
+            direction = "Moving forward"
         
         elif angle > -3*math.pi/4 and angle < -math.pi/4:
             # Move backward
-            print(stats + "Moving backward")
+            direction = "Moving backward"
         
         elif angle >= 3*math.pi/4 or angle <= -3*math.pi/4:
             # Turn left
-            print(stats + "Turning left")
+            direction = "Turning left"
         
         else:
             # Turn right
-            print(stats + "Turning right")
+            direction = "Turning right"
+
+        tick_log.debug("CAR: %d | Battery level: %.2f | Autonomy: %.2f | Coord: %s | %s", self.ID, self.battery_level, self.autonomy, self.interpolation_to_coord(), direction, extra={"car": self.ID})
         
         return self.battery_level, self.autonomy
 
     def interpolation_to_coord(self):
-        # Get current 
-        base_coord_index = min(math.floor(self.interpolation_val), len(self.coordinates) - 1)
-        next_coord_index = min(base_coord_index + 1, len(self.coordinates) - 1)
-
-        # Compute interpolated position
-        remainder_interpolation = self.interpolation_val % 1
-        latitude = self.coordinates[base_coord_index][1]*(1-remainder_interpolation) + self.coordinates[next_coord_index][1]*remainder_interpolation
-        longitude = self.coordinates[base_coord_index][0]*(1-remainder_interpolation) + self.coordinates[next_coord_index][0]*remainder_interpolation
-
+        latitude, longitude, _ = self.route.position(self.distance)
         return (latitude, longitude)
-    
-    def interpolation_to_next_coord(self):
-        # Get current
-        base_coord_index = min(math.floor(self.interpolation_val), len(self.coordinates) - 1)
-        next_coord_index = min(base_coord_index + 1, len(self.coordinates) - 1)
-
-        # Compute interpolated position
-        remainder_interpolation = self.interpolation_val % 1
-        latitude = self.coordinates[base_coord_index][1]*(1-remainder_interpolation) + self.coordinates[next_coord_index][1]*remainder_interpolation
-        longitude = self.coordinates[base_coord_index][0]*(1-remainder_interpolation) + self.coordinates[next_coord_index][0]*remainder_interpolation
 
-        # Check if we are at the end
-        if base_coord_index == next_coord_index:
-            return (latitude, longitude, len(self.coordinates) - 1)
+    # Fraction of the current route already driven, 0 while idle
+    def progress(self):
+        if self.route is None or len(self.route) < 2:
+            return 0.0
+        return min(self.interpolation_val / (len(self.route) - 1), 1.0)
 
-        # Compute direction unit vector
-        latitude_distance = self.coordinates[next_coord_index][1] - self.coordinates[base_coord_index][1]
-        longitude_distance = self.coordinates[next_coord_index][0] - self.coordinates[base_coord_index][0]
-        modulo = max(math.sqrt(latitude_distance*latitude_distance + longitude_distance*longitude_distance), 0.001)
-
-        latitude_uv = latitude_distance/modulo
-        longitude_uv = longitude_distance/modulo
-
-        # Compute next pos
-        latitude = latitude + latitude_uv*car_speed*delta_time
-        longitude = longitude + longitude_uv*car_speed*delta_time
-
-        # Compute interpolation value
-        interpolation_val = base_coord_index + ((latitude - self.coordinates[base_coord_index][1]) / (self.coordinates[next_coord_index][1] - self.coordinates[base_coord_index][1]))
+    # Moves the car car_speed*delta_time along the route and returns the new
+    # position with its interpolation value (segment index + fraction)
+    def interpolation_to_next_coord(self):
+        self.distance = min(self.distance + car_speed*delta_time, self.route.length)
+        return self.route.position(self.distance)
+
+    # Forced anomalies checked on every tick of a ride. Returns True when the
+    # car has to stop following the current route.
+    def ride_anomaly(self):
+        kind, battery_level, _ = anomalies[self.anomalia]
+
+        if kind == "breakdown":
+            self.ride_stopped = True
+            return True
+
+        # Still in the first half of the way to the hive, turn around
+        if not self.car_return and (len(self.route)-1)/2 > int(self.interpolation_val):
+            self.car_return = True
+            self.route = self.route.truncated(int(self.interpolation_val)).reversed()
+            self.interpolation_val = 0
+            self.distance = 0
+            self.ride_stopped = True
+            return True
 
-        # Make sure we didn't overshoot
-        if(next_coord_index < interpolation_val):
-            latitude = self.coordinates[next_coord_index][1]
-            longitude = self.coordinates[next_coord_index][0]
-            interpolation_val = next_coord_index
+        self.battery_level = battery_level
+        if self.status != 7:
+            self.update_status(self.ID, 7)
 
-        return (latitude, longitude, interpolation_val)
+        return False
 
-    def start_car(self):
-        self.interpolation_val = 0
-        while self.interpolation_val < len(self.coordinates) - 1:
+    # Scalar ride, one tick of this car at a time
+    def drive(self):
+        while self.distance < self.route.length:
             x1, y1 = self.interpolation_to_coord()
             x2, y2, self.interpolation_val = self.interpolation_to_next_coord()
 
-            if self.anomalia_forcada:
-                if self.anomalia == "breakdown" or self.anomalia == "unncomunicate":
-                    break
-                elif (len(self.coordinates)-1)/2 > int(self.interpolation_val):
-                    self.car_return = not self.car_return
-                    self.coordinates = self.coordinates[:int(self.interpolation_val)]
-                    self.interpolation_val = 0
-                    self.coordinates.reverse()
-                    break
-                elif self.anomalia == "set_battery_10":
-                    self.battery_level = 10
-                    self.update_status(self.ID, 7)
-                elif self.anomalia == "set_battery_5":
-                    self.battery_level = 5
-                    self.update_status(self.ID, 7)
-
+            if self.anomalia_forcada and self.ride_anomaly():
+                return
 
             # Calculate the distance between the current point and the next point
             distance = (x2 - x1, y2 - y1)
@@ -189,19 +291,39 @@ class vcar:
             # Send the car position to Cloud
             self.send_location(self.ID, (x2, y2), 4 if self.car_return else 3, self.battery_level, self.autonomy)
 
+            metrics.ticks.inc()
+
             # Add some delay to simulate the car movement
-            time.sleep(delta_time)
+            yield delta_time
 
-        if not self.anomalia_forcada:
+    # resume carries on with a ride restored from a checkpoint
+    def start_car(self, resume=False):
+        if not resume:
+            self.interpolation_val = 0
+            self.distance = 0
+            self.ride_stopped = False
+
+        if self.stepper is not None:
+            # The fleet stepper advances this car together with the rest of the
+            # fleet and releases the waiter when the ride is over
+            yield self.stepper.add(self)
+        else:
+            yield from self.drive()
+
+        # At the end of the route, the next ride goes the other way
+        if not self.ride_stopped:
             self.car_return = not self.car_return
             self.interpolation_val = 0
-            self.coordinates.reverse()
+            self.distance = 0
+            self.route = self.route.reversed()
 
     def send_location(self, id, pos, status, battery, autonomy):
         latitude, longitude = pos
 
-        # Connect to MQTT server
-        self.clientS.connect(mqtt_address, mqtt_port, 60)
+        if positions is not None:
+            positions.move(id, latitude, longitude)
+        if fleet_status is not None:
+            fleet_status.location(id, latitude, longitude, self.battery_level, autonomy, self.progress())
 
         # JSON
         msg = {	"id_car": 	        id,
@@ -214,275 +336,293 @@ class vcar:
                 "battery":          self.battery_level,
                 "autonomy":         autonomy}
 
-        # Code the JSON message as a string
-        mensaje_json = json.dumps(msg)
-
-        # Publish in "PTIN2023/CAR"
-        self.clientS.publish("PTIN2023/CAR/UPDATELOCATION", mensaje_json)
-
-        # Close MQTT connection
-        self.clientS.disconnect()
+        # Publish in "PTIN2023/CAR/UPDATELOCATION" and/or the fleet batch
+        self.publisher.publish_location(msg)
 
     def update_status(self, id, status):
-
-        # Connect to MQTT server
-        self.clientS.connect(mqtt_address, mqtt_port, 60)
+        self.status = status
+        if fleet_status is not None:
+            fleet_status.status(id, status, self.battery_level, self.autonomy, self.progress())
 
         # JSON
         msg = {	"id_car":       id,
                 "status_num":   status,
                 "status":       status_car[status] }
 
-        # Code the JSON message as a string
-        mensaje_json = json.dumps(msg)
-
-        # Publish in "PTIN2023/CAR"
-        self.clientS.publish("PTIN2023/CAR/UPDATESTATUS", mensaje_json)
-
-        print("CAR: " + str(id) + " | STATUS:  " + status_desc[status])
+        # Publish in "PTIN2023/CAR/UPDATESTATUS"
+        self.publisher.publish_status(msg)
 
-        # Close MQTT connection
-        self.clientS.disconnect()
+        car_log.info("CAR: %d | STATUS:  %s", id, status_desc[status], extra={"car": id})
 
     def send_anomaly_report(self, id, description):
 
-        self.clientS.connect(mqtt_address, mqtt_port, 60)
-
         msg = {	"id_car":      id,
                 "result":   "ok",
                 "description":       description}
 
         mensaje_json = json.dumps(msg)
     
-        self.clientS.publish("PTIN2023/CAR/REPORTANOMALIA", mensaje_json)
-        print("CAR: " + str(id) + " | ANOMALIA:  " + self.anomalia + " -> " + description)
-        
-        self.clientS.disconnect()
+        self.publisher.publish("PTIN2023/CAR/REPORTANOMALIA", mensaje_json)
+        car_log.warning("CAR: %d | ANOMALIA:  %s -> %s", id, self.anomalia, description, extra={"car": id})
 
 # ------------------------------------------------------------------------------ #
 
-    def on_connect(self, client, userdata, flags, rc):
-        if rc == 0:
-            print(f"CAR {self.ID} | Cloud connectat amb èxit.")
-        client.subscribe("PTIN2023/#")
-        
-    def on_message(self, client, userdata, msg):
-        if msg.topic == "PTIN2023/CAR/STARTROUTE":
-            if self.coordinates == None:
-                if(is_json(msg.payload.decode('utf-8'))):
-                    
-                    payload = json.loads(msg.payload.decode('utf-8'))
-                    needed_keys = ["id_car", "order", "route"]
-
-                    if all(key in payload for key in needed_keys):                
-                        if self.ID == payload[needed_keys[0]] and payload[needed_keys[1]] == 1:
-                            self.coordinates = json.loads(payload[needed_keys[2]])
-                            print("RECEIVED ROUTE: " + str(self.coordinates[0]) + " -> " + str(self.coordinates[-1]))
-                    else:
-                        print("FORMAT ERROR! --> PTIN2023/CAR/STARTROUTE")        
-                else:
-                    print("Message: " + msg.payload.decode('utf-8'))
-
-        elif msg.topic == "PTIN2023/CAR/ANOMALIA":
-
-            if(is_json(msg.payload.decode('utf-8'))):
-                
-
-                payload = json.loads(msg.payload.decode('utf-8'))
-                needed_keys = ["id_car", "hehe"]
-                
-                if all(key in payload for key in needed_keys):                
-                    if self.ID == payload[needed_keys[0]]:
-                        self.anomalia_forcada = True
-                        self.anomalia = payload[needed_keys[1]]
-                        print("Rebuda anomalia forçada: %s" % (self.anomalia))
-                else:
-                    print("FORMAT ERROR! --> PTIN2023/CAR/ANOMALIA") 
-
-            else:
-                print("Message: " + msg.payload.decode('utf-8'))
-
-    def start(self):
-
-        clientR = mqtt.Client()
-        clientR.on_connect = self.on_connect
-        clientR.on_message = self.on_message
-
-        clientR.connect(mqtt_address, mqtt_port, 60)
-        clientR.loop_forever()
+    # Commands are received by the fleet dispatcher, which decodes and validates
+    # each message once (commands.py) and only forwards it to the car whose id
+    # matches "id_car".
+    def on_startroute(self, payload):
+        with self.lock:
+            if self.route == None and payload["order"] == 1:
+                try:
+                    route = routes.get(payload["route"])
+                except ValueError as error:
+                    car_log.error("FORMAT ERROR! --> PTIN2023/CAR/STARTROUTE (%s)", error, extra={"car": self.ID})
+                    return
+
+                self.route = route
+                car_log.info("CAR: %d | RECEIVED ROUTE: %s -> %s", self.ID, route.point(0), route.point(-1), extra={"car": self.ID})
+                if route.received != len(route):
+                    car_log.info("CAR: %d | ROUTE: %d punts rebuts, %d eliminats en simplificar, %d compilats",
+                                 self.ID, route.received, route.received - route.simplified, len(route), extra={"car": self.ID})
+
+                # Wake up the lifecycle right away
+                self.route_ready.set()
+
+    def on_anomalia(self, payload):
+        if payload["hehe"] not in anomalies:
+            car_log.error("FORMAT ERROR! --> PTIN2023/CAR/ANOMALIA (unknown anomaly %s)", payload["hehe"], extra={"car": self.ID})
+            return
+
+        with self.lock:
+            self.anomalia_forcada = True
+            self.anomalia = payload["hehe"]
+        car_log.warning("CAR: %d | Rebuda anomalia forçada: %s", self.ID, payload["hehe"], extra={"car": self.ID})
 
 # ------------------------------------------------------------------------------ #
 
-    def control(self):
-        while True:
-
-            # Dos tipus de control, si hi ha anomalia o si no hi ha.
-            if self.coordinates != None and not self.start_coordinates:
-                self.start_coordinates = True
-
-                # En proceso de carga ~ 10s
-                self.update_status(self.ID, 1) # update_status(ID, 1, 0)
-                time.sleep(10)
-
-                # En reparto
-                self.update_status(self.ID, 3) # update_status(ID, 3, 3)
-                self.start_car()
-
-            time.sleep(0.25)
-
-            if self.start_coordinates:
-                                
-                if self.car_return:
-                    # Anomalia bateria baixa (<10%, >5%)
-                    if self.anomalia == "set_battery_10":
-                        self.battery_level = 10
-                        self.anomalia_forcada = False
-                        description = ("ATENCIÓ: Nivell de bateria baix, " + str(self.battery_level) + "%. Accions: Retornant al punt de carga...")
-                        self.send_anomaly_report(self.ID, description)
-                        self.update_status(self.ID, 7)
-                        time.sleep(1)
-                        self.update_status(self.ID, 4)
-                        self.start_car()
-
-                        self.update_status(self.ID, 8)
-                        time.sleep(5)
-                        self.battery_level = 100
-                        self.update_status(self.ID, 5)
-                        self.start_coordinates = False
-
-                        self.coordinates = None
-                        self.car_return = False
-                        self.anomalia_forcada = False
-                        self.anomalia = None
-                        
-                    # Anomalia bateria baixa (<5%)
-                    elif self.anomalia == "set_battery_5":
-                        self.battery_level = 5
-                        self.anomalia_forcada = False
-                        description = ("CRÍTIC: Nivell de bateria critic, " + str(self.battery_level) + "%. Accions: Retornant al punt de carga...")
-                        self.send_anomaly_report(self.ID, description)
-                        self.update_status(self.ID, 7)
-                        time.sleep(1)
-                        self.update_status(self.ID, 4)
-                        self.start_car()
-
-                        self.update_status(self.ID, 8)
-                        time.sleep(5)
-                        self.battery_level = 100
-                        self.update_status(self.ID, 5)
-                        self.start_coordinates = False
-
-                        self.coordinates = None
-                        self.car_return = False
-                        self.anomalia_forcada = False
-                        self.anomalia = None
-                        
-                    elif self.anomalia == "breakdown" or self.anomalia == "unncomunicate":
-                        description = ("CRÍTIC: El Cotxe ha sofert un problema tècnic. Codi d'error: " + self.anomalia + ". Accions: Es requereix que un tècnic es desplaçi a l'útima localització del cotxe.")
-                        self.send_anomaly_report(self.ID, description)
-                        self.update_status(self.ID, 7)
-                        
-                        self.start_coordinates = False
-                        self.coordinates = None
-                        self.car_return = False
-                        self.anomalia_forcada = False
-                        self.anomalia = None
-                        exit()
-
-                    else:
-                        # En proceso de descarga ~ 10s
-                        self.update_status(self.ID, 2) # update_status(ID, 2, 0)
-                        time.sleep(5)
-
-                        # Vuelta al almacén
-                        self.update_status(self.ID, 4) # update_status(ID, 4, 0)
-                        self.start_car()
-                                
-                else:
-                    # Anomalia bateria baixa (<10%, >5%)
-                    if self.anomalia == "set_battery_10":
-
-                        self.battery_level = 10
-                        self.anomalia_forcada = False
-                        description = ("ATENCIÓ: Nivell de bateria baix, " + str(self.battery_level) + "%. Accions: Retornant al punt de carga...")
-                        self.send_anomaly_report(self.ID, description)
-                        self.update_status(self.ID, 7)
-                        time.sleep(1)
-                        self.update_status(self.ID, 2)
-                        time.sleep(5)
-                        self.battery_level = 100
-                        self.update_status(self.ID, 4)
-                        self.start_car()
-                        self.start_coordinates = False
-
-                        self.coordinates = None
-                        self.car_return = False
-                        self.anomalia_forcada = False
-                        self.anomalia = None
-                        time.sleep(5)
-                        self.battery_level = 100
-                        self.update_status(self.ID, 5)
-                        
-                    # Anomalia bateria baixa (<5%)
-                    elif self.anomalia == "set_battery_5":
-                        self.battery_level = 5
-                        self.anomalia_forcada = False
-                        description = ("CRÍTIC: Nivell de bateria critic, " + str(self.battery_level) + "%. Accions: Retornant al punt de carga...")
-                        self.send_anomaly_report(self.ID, description)
-                        self.update_status(self.ID, 7)
-                        time.sleep(1)
-                        self.update_status(self.ID, 2)
-                        time.sleep(5)
-                        self.battery_level = 100
-                        self.update_status(self.ID, 4)
-                        self.start_car()
-                        self.start_coordinates = False
-
-                        self.coordinates = None
-                        self.car_return = False
-                        self.anomalia_forcada = False
-                        self.anomalia = None
-                        time.sleep(5)
-                        self.battery_level = 100
-                        self.update_status(self.ID, 5)
-
-                    elif self.anomalia == "breakdown" or self.anomalia == "unncomunicate":
-                        description = ("CRÍTIC: El cotxe ha sofert un problema tècnic. Codi d'error: " + self.anomalia + ". Accions: Es requereix que un tècnic es desplaçi a l'útima localització del cotxe.")
-                        self.send_anomaly_report(self.ID, description)
-                        self.update_status(self.ID, 7)
-                        
-                        self.start_coordinates = False
-                        self.coordinates = None
-                        self.car_return = False
-                        self.anomalia_forcada = False
-                        self.anomalia = None
-                        exit()
-
-                    else:
-                        # En espera
-                        self.update_status(self.ID, 5)
-                        self.start_coordinates = False
-
-                        self.car_return = False
-                        self.coordinates = None
-                        self.battery_level = 100
+    # What the lifecycle has to do about forced anomalies, see car_states.py
+    def outcome(self):
+        if not self.anomalia_forcada:
+            return "ok"
 
+        kind = anomalies[self.anomalia][0]
+        if kind == "battery" and self.ride_stopped:
+            return "turned"
+        return kind
 
-# ------------------------------------------------------------------------------ #
-# ------------------------------------------------------------------------------ #
+    # Actions of car_states.steps
 
-if __name__ == '__main__':
+    def finish(self):
+        self.battery_level = 100
+        self.route = None
+        self.car_return = False
+        self.anomalia_forcada = False
+        self.anomalia = None
+
+    def battery_alert(self):
+        _, battery_level, description = anomalies[self.anomalia]
+        self.battery_level = battery_level
+        self.anomalia_forcada = False
+        self.send_anomaly_report(self.ID, description % battery_level)
+
+    def breakdown(self):
+        _, _, description = anomalies[self.anomalia]
+        self.send_anomaly_report(self.ID, description % self.anomalia)
+
+        self.route = None
+        self.car_return = False
+        self.anomalia_forcada = False
+        self.anomalia = None
+
+    # Whole life of the car as a generator that walks car_states.steps and
+    # yields the seconds it has to wait, so the same logic can be driven by a
+    # thread, by a coroutine or by the discrete event clock.
+    def lifecycle(self):
+        return locked(self.walk(), self.lock)
+
+    def walk(self):
+        resume, self.resume = self.resume, False
+
+        while self.state is not None:
+            status, action, wait, next = steps[self.state]
+
+            # A restored car does not run the action of its step again, but
+            # publishes its status so the cloud sees it back. A status already
+            # published (alert sent mid-ride by ride_anomaly) is not repeated.
+            if action is not None and not resume:
+                getattr(self, action)()
+            if status is not None and (resume or status != self.status):
+                self.update_status(self.ID, status)
+
+            if wait == ROUTE:
+                # Idle cars cost nothing: they block until on_startroute signals
+                # a new route instead of polling for it
+                if self.route == None:
+                    self.route_ready = waiter()
+                    if self.route == None:
+                        yield self.route_ready
+            elif wait == RIDE:
+                yield from self.start_car(resume)
+            elif wait:
+                yield wait
+            resume = False
+
+            if isinstance(next, dict):
+                next = next.get(self.outcome(), next["ok"])
+            self.state = next
+
+    # Thread engine: one OS thread per car
+    def control(self, clock):
+        run_thread(self.lifecycle(), clock)
+
+    # asyncio engine: every car is a coroutine and every wait a timer on the loop
+    async def control_async(self, clock):
+        await run_async(self.lifecycle(), clock)
 
-    threads = []
 
-    for i in range(1, num_cars+1):
-        car = vcar(i)
-        API = Thread(target=car.start)
-        CTL = Thread(target=car.control)
+# ------------------------------------------------------------------------------ #
+# ------------------------------------------------------------------------------ #
+
+# processes are the fleet-wide simulation processes (stepper, scenario, ...)
+async def run_fleet(cars, sim_clock, processes=()):
+    coroutines = [car.control_async(sim_clock) for car in cars]
+    for process in processes:
+        coroutines.append(run_async(process, sim_clock))
+
+    await asyncio.gather(*coroutines)
+
+def make_clock():
+    if engine == "discrete":
+        return virtual_clock()
+    return clock(time_scale)
+
+def count_states(cars):
+    states = dict.fromkeys(status_car.values(), 0)
+    for car in cars:
+        states[status_car[car.status]] += 1
+    return states
+
+def make_fleet(clientS, clientR):
+    stepper = None
+    if stepper_kind == "numpy":
+        # numpy is only needed for this mode
+        from fleet_stepper import fleet_stepper
+        stepper = fleet_stepper(car_speed, delta_time, clientS)
+
+    cars = []
+    for i in range(first_car, first_car+num_cars):
+        car = vcar(i, clientS, stepper)
+        clientR.register(car)
+        cars.append(car)
+
+    return cars, stepper
+
+# on_fleet(cars) is called once the fleet is built, before it starts running
+def main(on_fleet=None):
+    fleet_log.setup(log_level, log_ticks, tick_log_interval, log_format)
+
+    sim_clock = make_clock()
+
+    # One MQTT connection for all the outgoing traffic of the fleet
+    clientS = publisher(mqtt_address, mqtt_port, wire=wire)
+    if publish_queue_size > 0:
+        clientS.enable_queue(publish_queue_size, publish_max_inflight)
+    if batch_telemetry:
+        clientS.enable_batching(batch_size, batch_interval, per_car_telemetry)
+    if telemetry_deadband:
+        clientS.enable_deadband(sim_clock, telemetry_min_distance, telemetry_battery_delta, telemetry_heartbeat)
+
+    # One MQTT connection for all the incoming commands of the fleet
+    clientR = dispatcher(mqtt_address, mqtt_port)
+    if not forced_anomalies:
+        clientR.handlers = {topic: handler for topic, handler in dispatcher.handlers.items() if handler != "on_anomalia"}
+
+    if record_file:
+        clientS.recorder = clientR.recorder = recorder(record_file, sim_clock)
+        atexit.register(clientS.recorder.close)
+
+    # Registered after the recorder so it still captures what is flushed
+    atexit.register(clientS.stop)
+
+    cars, stepper = make_fleet(clientS, clientR)
+    if positions is not None:
+        clientR.query("PTIN2023/CAR/NEAREST", lambda payload: nearest_cars(positions, clientR.cars, status_car, payload), clientS)
+    if checkpoint_file and os.path.exists(checkpoint_file):
+        checkpoint.restore(checkpoint_file, cars)
+    if fleet_status is not None:
+        for car in cars:
+            fleet_status.add(car)
+        clientR.query("PTIN2023/CAR/FLEETSTATUS", fleet_status.query, clientS)
+        metrics.pages["/fleet"] = fleet_status.query
+    fleet_log.start_summary(cars, status_car, log_summary_interval)
+
+    metrics.gauge("vcars_cars", "Cars in every status_car state", lambda: count_states(cars), "state")
+    metrics.gauge("vcars_publish_queue", "Messages waiting to be sent", clientS.queue_depth, "queue")
+    metrics.gauge("vcars_route_cache", "Compiled route cache", lambda: {"size": len(routes), "hits": routes.hits, "misses": routes.misses,
+                                                                    "points_in": routes.points_in, "points_out": routes.points_out}, "stat")
+    if metrics_port:
+        metrics.serve(int(metrics_port))
+    if metrics_interval > 0:
+        metrics.start_publishing(clientS, metrics_interval, metrics_topic)
+
+    if on_fleet is not None:
+        on_fleet(cars)
+
+    # Fleet-wide processes, the periodic ones that never end apart (the
+    # discrete engine runs them only alongside the rest, see engine.py)
+    processes = []
+    periodic = []
+    if stepper is not None:
+        processes.append(stepper.ticks(sim_clock))
+    if scenario_file:
+        seed = int(scenario_seed) if scenario_seed is not None else None
+        rules = scenario.load(scenario_file, seed)
+        if engine == "discrete" and not sim_duration and rules.endless():
+            raise SystemExit("SCENARIO | %s no s'acaba mai: cal SIM_DURATION amb ENGINE=discrete" % scenario_file)
+        processes.append(rules.process(cars, clientR, sim_clock, status_car))
+    if batch_telemetry and stepper is None:
+        # The stepper flushes the fleet batch once per tick itself
+        processes.append(clientS.batching())
+    if checkpoint_file:
+        periodic.append(checkpoint.process(checkpoint_file, cars, sim_clock, checkpoint_interval))
+
+    if engine == "discrete":
+        # Every car and the stepper are processes of the virtual clock, commands
+        # from the cloud are picked up at the current simulated time
+        for car in cars:
+            sim_clock.spawn(car.lifecycle())
+        for process in processes:
+            sim_clock.spawn(process)
+        for process in periodic:
+            sim_clock.spawn(process, daemon=True)
+
+        clientR.start_background()
+        sim_clock.run(float(sim_duration) if sim_duration else None)
+
+    elif engine == "asyncio":
+        # paho keeps its own network thread, the cars share the main one
+        clientR.start_background()
+        asyncio.run(run_fleet(cars, sim_clock, processes + periodic))
+
+    else:
+        threads = []
+
+        for process in processes + periodic:
+            PRC = Thread(target=run_thread, args=(process, sim_clock))
+            threads.append(PRC)
+            PRC.start()
+
+        for car in cars:
+            CTL = Thread(target=car.control, args=(sim_clock,))
+            threads.append(CTL)
+            CTL.start()
+
+        API = Thread(target=clientR.start)
         threads.append(API)
-        threads.append(CTL)
         API.start()
-        CTL.start()
 
-    for t in threads:
-        t.join()
+        for t in threads:
+            t.join()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+import json
+import struct
+# ---------------------------- #
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Faster JSON decoder for the inbound commands when it is installed
+try:
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    loads = json.loads
+# ------------------------------------------------------------------------------ #
+# Wire formats for UPDATELOCATION, UPDATESTATUS and the fleet batch topic.
+#
+#   json     the original messages, {"id_car": ..., "location_act": {...}, ...}
+#   struct   fixed little endian records:
+#              location  id_car u32 | latitude f64 | longitude f64 |
+#                        status_num u8 | battery f32 | autonomy f32   (29 bytes)
+#              status    id_car u32 | status_num u8                   (5 bytes)
+#            a batch is just the location records one after the other
+#   msgpack  the same fields as a msgpack array, in the same order
+#
+# The struct and msgpack formats drop the "status" string, it can be recovered
+# from status_num with the status_car table.
+# ------------------------------------------------------------------------------ #
+
+formats = ["json", "struct", "msgpack"]
+
+location_record = struct.Struct("<IddBff")
+status_record = struct.Struct("<IB")
+
+def check_format(fmt):
+    if fmt not in formats:
+        raise ValueError("Unknown wire format: %s (%s)" % (fmt, ", ".join(formats)))
+    if fmt == "msgpack" and msgpack is None:
+        raise ValueError("The msgpack wire format needs the msgpack package installed")
+
+def location_fields(msg):
+    return (msg["id_car"], msg["location_act"]["latitude"], msg["location_act"]["longitude"],
+            msg["status_num"], msg["battery"], msg["autonomy"])
+
+def location_msg(fields):
+    id_car, latitude, longitude, status_num, battery, autonomy = fields
+    return {"id_car":       id_car,
+            "location_act": {
+                "latitude":     latitude,
+                "longitude":    longitude
+            },
+            "status_num":   status_num,
+            "battery":      battery,
+            "autonomy":     autonomy}
+
+# ------------------------------------------------------------------------------ #
+
+def encode_location(msg, fmt="json"):
+    if fmt == "struct":
+        return location_record.pack(*location_fields(msg))
+    elif fmt == "msgpack":
+        return msgpack.packb(location_fields(msg))
+    return json.dumps(msg)
+
+def encode_locations(msgs, fmt="json"):
+    if fmt == "struct":
+        return b"".join(location_record.pack(*location_fields(msg)) for msg in msgs)
+    elif fmt == "msgpack":
+        return msgpack.packb([location_fields(msg) for msg in msgs])
+    return json.dumps(msgs)
+
+def encode_status(msg, fmt="json"):
+    if fmt == "struct":
+        return status_record.pack(msg["id_car"], msg["status_num"])
+    elif fmt == "msgpack":
+        return msgpack.packb((msg["id_car"], msg["status_num"]))
+    return json.dumps(msg)
+
+# ------------------------------------------------------------------------------ #
+
+def decode_location(payload, fmt="json"):
+    if fmt == "struct":
+        return location_msg(location_record.unpack(payload))
+    elif fmt == "msgpack":
+        return location_msg(msgpack.unpackb(payload))
+    return json.loads(payload)
+
+def decode_locations(payload, fmt="json"):
+    if fmt == "struct":
+        return [location_msg(fields) for fields in location_record.iter_unpack(payload)]
+    elif fmt == "msgpack":
+        return [location_msg(fields) for fields in msgpack.unpackb(payload)]
+    return json.loads(payload)
+
+def decode_status(payload, fmt="json"):
+    if fmt == "struct":
+        id_car, status_num = status_record.unpack(payload)
+    elif fmt == "msgpack":
+        id_car, status_num = msgpack.unpackb(payload)
+    else:
+        return json.loads(payload)
+    return {"id_car": id_car, "status_num": status_num}